@@ -1,16 +1,23 @@
 import asyncio
+import contextlib
+import dataclasses # AgentState is a slotted dataclass
+import enum
+import functools
+import operator # operator.add reducer for AgentState.audit_trace
+import contextvars # For binding each agent run to its own pooled page
 from playwright.async_api import async_playwright, Playwright, Page, Browser, TimeoutError as PlaywrightTimeoutError
 import os
+from pathlib import Path
 from dotenv import load_dotenv
-import traceback # For better error logging
 import base64 # For encoding screenshot
-from io import BytesIO # For handling image bytes
-from PIL import Image # For image resizing
 import re # For regular expressions
 import json # For potentially parsing tool message content
-from typing import TypedDict, Annotated, List, Union, Optional
+from typing import Annotated, List, Union, Optional, Literal
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
 import logging # Ensure logging is imported
+import tiktoken # For token-based truncation of page text (installed with langchain-openai)
+import hashlib # For content-addressed LLM cache keys
+from collections import OrderedDict, deque # LRU memo for LLM answers; bounded log ring buffer
 
 # --- LangChain & LangGraph Imports ---
 from langchain_openai import ChatOpenAI
@@ -19,9 +26,18 @@ from langchain_core.output_parsers import StrOutputParser
 from langchain_core.tools import tool
 from langchain.globals import set_debug
 from langgraph.graph import StateGraph, END # Import StateGraph and END
+from langgraph.types import Command # Nodes return Command(update=..., goto=...) to route without separate edge functions
 # from langgraph.checkpoint.sqlite import SqliteSaver # <<< COMMENTED OUT this unused import - Now TRULY commenting out
 
-from bs4 import BeautifulSoup
+try:
+    import diskcache # Optional: persists vision LLM answers across runs
+except ImportError:
+    diskcache = None
+
+try:
+    import pybase64 as b64codec # Optional: SIMD base64, a drop-in for the stdlib functions used here
+except ImportError:
+    b64codec = base64
 
 # Assuming setup_logging() is defined somewhere and initializes a logger instance
 # For example:
@@ -32,76 +48,255 @@ from bs4 import BeautifulSoup
 # logger = setup_logging() 
 # OR, if logger is configured more directly:
 logger = logging.getLogger(__name__) # Default way to get a logger
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `maxlen` log records in memory for postmortems. Records are stored unformatted and are only
+    rendered by dump(), so keeping the trail costs one deque append per emitted record."""
+
+    def __init__(self, maxlen: int = 1000):
+        super().__init__()
+        self.records: deque[logging.LogRecord] = deque(maxlen=maxlen)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+    def dump(self) -> str:
+        return "\n".join(self.format(record) for record in self.records)
+
+trace_buffer = RingBufferHandler(maxlen=1000) # Attached to the logger by the __main__ logging setup
+TRACE_DUMP_PATH = "agent_trace_on_error.log" # Written from trace_buffer when a graph run fails
 # Ensure your logging configuration (level, handlers) is set up appropriately for this logger.
 # If you have a global `setup_logging` function that does this, ensure it's called before nodes are run.
 
-# <<< ADDED TOP-LEVEL DEBUG PRINT >>>
-print("[DEBUG] agent_main.py script started")
 # <<< END ADDED SECTION >>>
 
 # Load environment variables from .env file
 load_dotenv()
 
-# --- Enable LangChain Debug Mode ---
-set_debug(False)
-print("[LangChain] Debug mode disabled (set_debug(False)). Relying on custom prints.")
+# Debug screenshots are written to disk only when explicitly requested, so normal runs don't pay for an extra encode + write per step.
+DEBUG_SCREENSHOTS = os.getenv("DEBUG_SCREENSHOTS", "0") == "1"
+SCREENSHOT_JPEG_QUALITY = 75 # JPEG keeps the base64 payload (and vision input cost) far smaller than PNG
+
+# Pages keep a 1366x768 CSS viewport (so Google's desktop layout and locator clicks are unchanged), but are rasterised
+# at a device scale factor that makes screenshots come out at the 768px analysis width directly - no Pillow resize needed.
+# Set FULL_RES_SCREENSHOTS=1 to capture at full resolution instead (e.g. when debugging pixel-level targeting).
+VIEWPORT_SIZE = {"width": 1366, "height": 768}
+SCREENSHOT_MAX_WIDTH = 768
+# OpenAI vision "detail" level for every screenshot sent to GPT-4o. "low" bills a flat ~85 tokens per image, while
+# "high"/"auto" tile the 768px shot; set VISION_IMAGE_DETAIL=low if the camera icon / dialog is still found reliably.
+VISION_IMAGE_DETAIL = os.getenv("VISION_IMAGE_DETAIL", "auto")
+FULL_RES_SCREENSHOTS = os.getenv("FULL_RES_SCREENSHOTS", "0") == "1"
+
+# Accessible-name patterns for the "Search by image" (camera) button, compiled once
+_CAMERA_BTN_RE = re.compile('按图搜索|Search by image', re.IGNORECASE)
+_SEARCH_FALLBACK_RE = re.compile('搜索|Search', re.IGNORECASE)
+# Known locators for the camera button, in the order _click_camera_button prefers them
+_CAMERA_SELECTORS = (
+    "div[aria-label='按图搜索']",
+    "div[aria-label='Search by image']",
+    "button[aria-label='按图搜索']",
+    "button[aria-label='Search by image']",
+    "span[aria-label='按图搜索']", # Try span as well
+    "span[aria-label='Search by image']",
+    "div[role='button'][aria-label*='搜索']", # More generic search label
+    "div[role='button'][aria-label*='Search']",
+    "textarea[aria-label='搜索图片'] + div >> internal:control=enter-frame >> div[role='button'][aria-label*='搜索']" # Example complex selector if icon is in sibling div or frame
+)
+_CAMERA_CSS_SELECTORS = tuple(selector for selector in _CAMERA_SELECTORS if ">>" not in selector) # Valid for document.querySelector
+_CAMERA_ENGINE_SELECTORS = tuple(selector for selector in _CAMERA_SELECTORS if ">>" in selector) # Need Playwright's selector engine
+_CAMERA_ROLE_PATTERNS = (
+    ("button", _CAMERA_BTN_RE),
+    ("link", _CAMERA_BTN_RE), # Sometimes it might be a link
+    ("button", _SEARCH_FALLBACK_RE) # Generic fallback
+)
+# Log labels for the strategy-2 locators, index-aligned with the list _click_camera_button races
+_CAMERA_FALLBACK_STRATEGIES = tuple(f"get_by_role: role={role}, name={name_regex.pattern}" for role, name_regex in _CAMERA_ROLE_PATTERNS) + \
+                              tuple(f"selector: {selector}" for selector in _CAMERA_ENGINE_SELECTORS)
+# Signals used instead of fixed sleeps: the upload dialog's file input attaching after a click, and the page navigating away after upload
+UPLOAD_DIALOG_TIMEOUT_MS = 10000
+UPLOAD_DIALOG_READY_SELECTOR = "input[type='file']"
+RESULTS_URL_TIMEOUT_MS = 20000
+# Only a sanity check on the URL reached after upload (legacy sbi, Lens udm=26, lens.google.com); any navigation ends the wait
+_RESULTS_URL_RE = re.compile(r"google\.[a-z.]+/search\?.*(?:tbs=sbi|udm=26)|lens\.google\.com")
+NAVIGATION_TIMEOUT_MS = 15000 # page.goto() until domcontentloaded
+PAGE_READY_SELECTOR = "input[aria-label*='search' i], textarea" # Google's search box, rendered once the page is usable
+PAGE_READY_TIMEOUT_MS = 5000
+FAST_CLICK_TIMEOUT_MS = 1000 # Per-strategy budget for the deterministic camera-button probe tried before the vision LLM
+
+# --- LangChain Debug Mode ---
+# set_debug(True) makes every LangChain component dump its full inputs/outputs (base64 screenshots included) to stdout,
+# so it is opt-in via LANGCHAIN_DEBUG=1.
+if os.getenv("LANGCHAIN_DEBUG") == "1":
+    set_debug(True)
+    print("[LangChain] Debug mode enabled (LANGCHAIN_DEBUG=1).")
+else:
+    set_debug(False)
 
 # --- LLM Initialization ---
 try:
     # Using GPT-4o as it's generally strong in reasoning and potentially vision later
     # Ensure your OpenAI key has access to this model or change to gpt-3.5-turbo etc.
-    llm = ChatOpenAI(model="gpt-4o", temperature=0, max_tokens=1024) # Using gpt-4o, explicitly set max_tokens
+    # No client-wide max_tokens: each chain binds a completion budget sized to the answer it expects
+    llm = ChatOpenAI(model="gpt-4o", temperature=0)
     print("ChatOpenAI LLM initialized successfully with gpt-4o.")
 except Exception as e:
     print(f"Error initializing ChatOpenAI: {e}")
     print("Please ensure your OPENAI_API_KEY is set correctly in the .env file and has access to gpt-4o.")
     exit()
 
+# --- Token Budgeting ---
+# Page text is capped by tokens rather than characters, since tokens are what GPT-4o actually bills and attends over.
+MAX_PAGE_TEXT_TOKENS = 750 # Applied when a page is captured (roughly the old 3000-character cap)
+PROMPT_TEXT_SNIPPET_TOKENS = 400 # Applied to the page text embedded next to a screenshot in a vision prompt
+RESULTS_PAGE_TEXT_TOKENS = 1300 # Applied by _capture_current_page (roughly the old 1000-word cap)
+try:
+    _token_encoding = tiktoken.encoding_for_model("gpt-4o")
+except Exception as e:
+    # tiktoken fetches the BPE file on first use; fall back to character slicing if it is unavailable
+    print(f"[Tokenizer] Could not load the gpt-4o encoding ({e}). Falling back to character-based truncation.")
+    _token_encoding = None
+
+def trim_to_tokens(text: str | None, max_tokens: int) -> str:
+    """Truncates text to at most max_tokens GPT-4o tokens, appending an ellipsis if anything was cut."""
+    if not text:
+        return ""
+    if _token_encoding is None:
+        max_chars = max_tokens * 4 # ~4 characters per token for English text
+        return text if len(text) <= max_chars else text[:max_chars] + "…"
+    tokens = _token_encoding.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _token_encoding.decode(tokens[:max_tokens]) + "…"
+
 # --- Playwright Browser/Page Management ---
+# One browser process is shared by every agent run; each run gets its own pre-warmed page in an isolated BrowserContext
+# (separate cookies/storage) from the PagePool, so Chromium/context startup is paid ahead of time instead of per run.
+PAGE_POOL_SIZE = int(os.getenv("AGENT_MAX_PAGES", "1")) # Number of warm pages kept ready, i.e. how many agent runs can execute concurrently
+PLAYWRIGHT_SLOW_MO = int(os.getenv("PLAYWRIGHT_SLOW_MO", "0")) # ms slept before every Playwright action; only useful for watching a debug run
+HEADLESS = os.getenv("HEADLESS", "1") == "1" # Set HEADLESS=0 to watch the agent drive a visible browser window
+
 _playwright_instance: Playwright | None = None
 _browser_instance: Browser | None = None
-_page_instance: Page | None = None # Global page instance for the agent's current context
+# Concurrent runs may all hit a cold start at once; the locks make sure only one Playwright driver / Chromium is launched
+_playwright_lock = asyncio.Lock()
+_browser_lock = asyncio.Lock()
+_current_page: contextvars.ContextVar[Page | None] = contextvars.ContextVar("current_page", default=None) # Page acquired by the running agent task
 
 async def get_playwright() -> Playwright:
     global _playwright_instance
     if _playwright_instance is None:
-        print("[Browser Manager] Starting Playwright...")
-        _playwright_instance = await async_playwright().start()
+        async with _playwright_lock:
+            if _playwright_instance is None: # Re-check: another task may have started it while we waited
+                print("[Browser Manager] Starting Playwright...")
+                _playwright_instance = await async_playwright().start()
     return _playwright_instance
 
 async def get_browser(p: Playwright | None = None) -> Browser:
     global _browser_instance
     if _browser_instance is None:
-        pw = p or await get_playwright()
-        try:
-            # Running headless=False for initial debugging of the agent flow
-            _browser_instance = await pw.chromium.launch(headless=False, slow_mo=100) 
-            print("[Browser Manager] New browser instance launched.")
-        except Exception as e:
-            print(f"[Browser Manager] Error launching browser: {e}")
-            raise
+        async with _browser_lock:
+            if _browser_instance is None: # Re-check: another task may have launched it while we waited
+                pw = p or await get_playwright()
+                try:
+                    _browser_instance = await pw.chromium.launch(headless=HEADLESS, slow_mo=PLAYWRIGHT_SLOW_MO)
+                    print("[Browser Manager] New browser instance launched.")
+                except Exception as e:
+                    print(f"[Browser Manager] Error launching browser: {e}")
+                    raise
     return _browser_instance
 
-async def get_page(b: Browser | None = None) -> Page:
-    """Gets the current page instance, creating it if necessary."""
-    global _page_instance
-    if _page_instance is None or _page_instance.is_closed():
-        browser = b or await get_browser()
+class PagePool:
+    """Hands out pre-warmed pages, one BrowserContext each, all backed by the shared browser process."""
+
+    def __init__(self, size: int = 1):
+        self.size = size
+        # None marks a slot whose page could not be recycled; acquire() creates it on demand
+        self._pages: asyncio.Queue[Page | None] = asyncio.Queue()
+        self._started = False
+        self._start_lock = asyncio.Lock() # Concurrent cold acquire()/warmup() calls must not each top up the pool
+
+    async def _new_page(self) -> Page:
+        browser = await get_browser()
         try:
-            _page_instance = await browser.new_page()
-            print("[Browser Manager] New page instance created.")
-            await _page_instance.set_viewport_size({"width": 1366, "height": 768})
+            device_scale_factor = 1 if FULL_RES_SCREENSHOTS else SCREENSHOT_MAX_WIDTH / VIEWPORT_SIZE["width"]
+            context = await browser.new_context(viewport=VIEWPORT_SIZE, device_scale_factor=device_scale_factor)
+            page = await context.new_page()
+            print(f"[Browser Manager] New page instance created (device_scale_factor={device_scale_factor:.3f}).")
+            return page
         except Exception as e:
             print(f"[Browser Manager] Error creating new page: {e}")
             raise
-    return _page_instance
-
-async def close_page_and_browser():
-    global _page_instance, _browser_instance, _playwright_instance
-    if _page_instance and not _page_instance.is_closed():
-        await _page_instance.close()
-        _page_instance = None
-        print("[Browser Manager] Page instance closed.")
+
+    async def start(self):
+        """Creates the pool's pages (launching the browser if needed). Idempotent once it has succeeded."""
+        if self._started:
+            return
+        async with self._start_lock:
+            if self._started: # Another caller finished starting the pool while we waited for the lock
+                return
+            # Only top up what is missing, so a retry after a partial failure doesn't overfill the pool
+            for _ in range(self.size - self._pages.qsize()):
+                self._pages.put_nowait(await self._new_page())
+            self._started = True
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """Checks a page out for one agent run and makes it the current page for get_page()."""
+        await self.start()
+        page = await self._pages.get()
+        if page is None:
+            # An earlier recycle failed: replace the page now, or hand the slot back and surface the error
+            try:
+                page = await self._new_page()
+            except Exception:
+                self._pages.put_nowait(None)
+                raise
+        token = _current_page.set(page)
+        try:
+            yield page
+        finally:
+            _current_page.reset(token)
+            # Drop the used context (cookies, dialogs, history) and warm up a fresh one for the next run
+            try:
+                await page.context.close()
+            except Exception as e:
+                print(f"[Browser Manager] Could not close used context: {e}")
+            try:
+                self._pages.put_nowait(await self._new_page())
+            except Exception as e:
+                # Keep the slot so the pool never shrinks and no acquire() waits on a queue nothing refills
+                self._pages.put_nowait(None)
+                print(f"[Browser Manager] Could not recycle page, will retry on next acquire: {e}")
+
+    async def close(self):
+        while not self._pages.empty():
+            page = self._pages.get_nowait()
+            if page is not None:
+                await page.context.close()
+        self._started = False
+
+page_pool = PagePool(PAGE_POOL_SIZE)
+
+async def get_page() -> Page | None:
+    """Gets the page acquired for the current agent run, or None if there is none (or it was closed)."""
+    page = _current_page.get()
+    if page is None or page.is_closed():
+        print("[Browser Manager] No active page for this run (use `async with page_pool.acquire():`).")
+        return None
+    return page
+
+async def warmup():
+    """Launches the shared browser and fills the page pool ahead of the first run. Call once at process startup
+    (before accepting tasks) so no agent run pays for the Chromium cold start; page_pool.acquire() does it lazily otherwise."""
+    await page_pool.start()
+    print(f"[Browser Manager] Warmed up {page_pool.size} page(s).")
+
+async def shutdown_browser():
+    """Closes the page pool, the shared browser and Playwright. Call once at process exit, not between runs:
+    runs only release their page (page_pool.acquire), so the next run reuses the warm browser."""
+    global _browser_instance, _playwright_instance
+    await page_pool.close()
+    print("[Browser Manager] Page pool closed.")
     if _browser_instance and _browser_instance.is_connected(): # Check if connected before closing
         await _browser_instance.close()
         _browser_instance = None
@@ -112,25 +307,78 @@ async def close_page_and_browser():
         print("[Browser Manager] Playwright instance stopped.")
 
 # Helper function to filter screenshot from state for cleaner logging
+_LARGE_STATE_KEYS = frozenset({"screenshot", "page_content"}) # Logged as a size summary instead of their contents
+
 def filter_screenshot_from_state(state_dict: dict) -> dict:
+    """Returns a log-friendly view of a state update: small values as-is, screenshot/page_content replaced by their sizes.
+    Builds one small dict instead of copying the update; callers gate it behind logger.isEnabledFor(logging.DEBUG)."""
     if not isinstance(state_dict, dict):
         # If it's not a dict (e.g., None or some other type passed by mistake), return it as is.
         # This can happen if a node returns something unexpected.
-        logger.debug(f"[Filter State] Input was not a dict, returning as is: {type(state_dict)}")
-        return state_dict 
-    filtered_state = state_dict.copy()
-    if "screenshot" in filtered_state and filtered_state["screenshot"]:
-        if isinstance(filtered_state["screenshot"], str):
-            # Limit the logged length to avoid excessive log even for length calculation
-            screenshot_len_kb = len(filtered_state["screenshot"]) / 1024
-            if screenshot_len_kb > 100: # Only show actual length if it's somewhat reasonable
-                 filtered_state["screenshot"] = f"[...screenshot_base64_omitted (len: {screenshot_len_kb:.1f}KB)...]"
-            else:
-                 filtered_state["screenshot"] = f"[...screenshot_base64_omitted (len: {screenshot_len_kb:.1f}KB)...]"
+        return state_dict
+    filtered_state = {key: value for key, value in state_dict.items() if key not in _LARGE_STATE_KEYS}
+    if "screenshot" in state_dict:
+        screenshot = state_dict["screenshot"]
+        if not screenshot:
+            filtered_state["screenshot"] = screenshot
+        elif isinstance(screenshot, str):
+            filtered_state["screenshot"] = f"[...screenshot_base64_omitted (len: {len(screenshot) / 1024:.1f}KB)...]"
         else:
             filtered_state["screenshot"] = "[...screenshot_base64_omitted (not a string format)...]"
+    if "page_content" in state_dict:
+        filtered_state["page_content"] = f"<len={len(state_dict['page_content'] or '')}>"
     return filtered_state
 
+# Rendered text only: the browser's own layout walk already skips scripts, styles and hidden elements.
+# Sliced in-page to a generous multiple of the token caps, so normalization and tokenizing cost O(prompt), not O(page).
+MAX_RAW_PAGE_TEXT_CHARS = 16000
+_PAGE_TEXT_JS = "(maxChars) => (document.body ? document.body.innerText : '').slice(0, maxChars)"
+_WS_RUN = re.compile(r"[ \t]{2,}")
+_WS_NEWLINE = re.compile(r"[ \t]*\n[ \t\n]*")
+
+def _normalize_page_text(text: str | None) -> str:
+    """Collapses runs of spaces/tabs and blank lines in innerText output, keeping one text run per line."""
+    if not text:
+        return ""
+    return _WS_NEWLINE.sub("\n", _WS_RUN.sub(" ", text)).strip()
+
+def _write_bytes(path: str, data: bytes) -> None:
+    """Blocking file write for debug screenshots; callers run it via asyncio.to_thread to keep it off the event loop."""
+    with open(path, "wb") as f:
+        f.write(data)
+
+_background_tasks: set[asyncio.Task] = set() # Strong refs to fire-and-forget tasks, so they aren't garbage-collected mid-run
+
+def _on_debug_save_done(path: str, task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if task.cancelled():
+        return
+    if task.exception() is not None:
+        logger.warning("[Debug Screenshot] Could not save debug screenshot %s: %s", path, task.exception())
+    else:
+        logger.debug("[Debug Screenshot] Saved to: %s", path)
+
+def _save_debug_screenshot(path: str, data: bytes) -> None:
+    """Writes a debug screenshot from a worker thread in the background; the capture does not wait for the disk.
+    Best effort: failures are only logged."""
+    task = asyncio.create_task(asyncio.to_thread(_write_bytes, path, data))
+    _background_tasks.add(task)
+    task.add_done_callback(functools.partial(_on_debug_save_done, path))
+
+def screenshot_digest(screenshot_bytes: bytes) -> str:
+    """Content hash of a screenshot's raw image bytes (not its base64, which is larger and only a transport encoding).
+    Pixel-identical captures get the same digest, which is what the LLM answer caches are keyed on."""
+    # BLAKE2b: faster than sha256, and the key does not need to be collision-resistant against an attacker
+    return hashlib.blake2b(screenshot_bytes, digest_size=16).hexdigest()
+
+def _process_capture(text_content: str | None, screenshot_bytes: bytes, max_tokens: int) -> tuple[str, str, str]:
+    """CPU side of a capture: normalizes and token-trims the page text, base64-encodes the screenshot and hashes it.
+    Returns (text, screenshot_base64, screenshot_hash). Run through asyncio.to_thread so one worker hop covers all of it
+    and concurrent runs' Playwright traffic isn't stalled behind it."""
+    text = trim_to_tokens(_normalize_page_text(text_content), max_tokens)
+    screenshot_base64 = b64codec.b64encode(screenshot_bytes).decode('ascii')
+    return text, screenshot_base64, screenshot_digest(screenshot_bytes)
+
 # Helper function to capture current page state - MOVED AND MODIFIED
 async def _capture_current_page() -> dict:
     """Captures current page URL, content, and screenshot. Handles errors."""
@@ -139,30 +387,27 @@ async def _capture_current_page() -> dict:
         logger.error("[Capture Page] Page not available or closed.")
         return {"current_url": None, "page_content": None, "screenshot": None, "error_message": "Page not available for capture."}
     try:
-        logger.debug("[Capture Page] Getting URL, HTML content, and screenshot...")
+        logger.debug("[Capture Page] Getting URL, page text, and screenshot...")
         url = page.url
         # content = await page.content() # Full content can be very large
 
-        # Simplified text extraction
-        text_content = await page.evaluate("document.body.innerText || \"\"") 
-        simplified_text = ' '.join(text_content.split()[:1000]) # Limit text length more generously for context
-        logger.debug(f"[Capture Page] Extracted text (limited): {simplified_text[:100]}...")
+        # Simplified text extraction; the evaluate and the screenshot are independent round trips, so issue them together
+        text_content, screenshot_bytes = await asyncio.gather(
+            page.evaluate(_PAGE_TEXT_JS, MAX_RAW_PAGE_TEXT_CHARS),
+            page.screenshot(type='jpeg', quality=SCREENSHOT_JPEG_QUALITY)
+        )
+        # Limit text length more generously for context
+        simplified_text, screenshot_b64, screenshot_hash = await asyncio.to_thread(_process_capture, text_content, screenshot_bytes, RESULTS_PAGE_TEXT_TOKENS)
+        logger.debug("[Capture Page] Extracted text (limited): %.100s...", simplified_text)
 
-        screenshot_bytes = await page.screenshot()
-        screenshot_b64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-        
-        debug_screenshot_path = "debug_captured_page.png" # Generic name
-        try:
-            with open(debug_screenshot_path, "wb") as f:
-                f.write(screenshot_bytes)
-            logger.info(f"[Capture Page] Debug screenshot saved to: {debug_screenshot_path}")
-        except Exception as e_ss_save:
-            logger.warning(f"[Capture Page] Could not save debug screenshot: {e_ss_save}")
+        if DEBUG_SCREENSHOTS:
+            _save_debug_screenshot("debug_captured_page.jpg", screenshot_bytes) # Generic name
 
         return {
             "current_url": url,
             "page_content": simplified_text, 
             "screenshot": screenshot_b64,
+            "screenshot_hash": screenshot_hash,
             "error_message": None
         }
     except Exception as e:
@@ -175,11 +420,49 @@ async def _capture_current_page() -> dict:
             pass
         return {"current_url": current_url_on_error, "page_content": None, "screenshot": None, "error_message": f"Error capturing page: {e}"}
 
+async def _capture_page_state(page: Page, *, navigate_to: str | None = None, capture_text: bool = True, debug_screenshot_path: str = "debug_screenshot.jpg") -> dict:
+    """Optionally navigates, then captures the page's text (unless capture_text=False) and analysis-size screenshot.
+    Returns {text_content, screenshot_base64, screenshot_hash, url}; errors propagate to the caller."""
+    if navigate_to:
+        logger.debug("[Capture Page State] Navigating to %s...", navigate_to)
+        # Google keeps background requests open, so networkidle is slow to arrive; wait for the DOM plus the search box instead
+        await page.goto(navigate_to, wait_until='domcontentloaded', timeout=NAVIGATION_TIMEOUT_MS)
+        try:
+            await page.wait_for_selector(PAGE_READY_SELECTOR, timeout=PAGE_READY_TIMEOUT_MS)
+        except PlaywrightTimeoutError:
+            logger.debug("[Capture Page State] %s not visible within %d ms; capturing anyway.", PAGE_READY_SELECTOR, PAGE_READY_TIMEOUT_MS)
+        logger.debug("[Capture Page State] Navigation successful. Getting content and screenshot...")
+
+    # Get screenshot as JPEG; the page's device scale factor already produces it at the analysis width.
+    # The innerText evaluate (Runtime domain) and page.screenshot() (Page domain) are independent, so issue them together.
+    text_content = None
+    if capture_text:
+        text_content, screenshot_bytes = await asyncio.gather(
+            page.evaluate(_PAGE_TEXT_JS, MAX_RAW_PAGE_TEXT_CHARS),
+            page.screenshot(type='jpeg', quality=SCREENSHOT_JPEG_QUALITY)
+        )
+    else:
+        screenshot_bytes = await page.screenshot(type='jpeg', quality=SCREENSHOT_JPEG_QUALITY)
+
+    if DEBUG_SCREENSHOTS:
+        _save_debug_screenshot(debug_screenshot_path, screenshot_bytes)
+
+    # Truncate text if too long for context, but keep screenshot
+    simplified_text, screenshot_base64, screenshot_hash = await asyncio.to_thread(_process_capture, text_content, screenshot_bytes, MAX_PAGE_TEXT_TOKENS)
+    logger.debug("[Capture Page State] Captured text and screenshot (text_len: %d, screenshot_size_approx_b64: %d).", len(simplified_text), len(screenshot_base64))
+
+    return {
+        "text_content": simplified_text,
+        "screenshot_base64": screenshot_base64,
+        "screenshot_hash": screenshot_hash,
+        "url": page.url
+    }
+
 # --- Tool Definitions (Keep the original tool functions for now) ---
 # We will call these functions from within our graph nodes.
 
 async def _browse_web_page_internal(url: str) -> dict:
-    print(f"\n[Internal Tool] _browse_web_page_internal(url='{url}')")
+    logger.debug("[Internal Tool] _browse_web_page_internal(url=%r)", url)
     try:
         page = await get_page()
         if not page: 
@@ -189,64 +472,15 @@ async def _browse_web_page_internal(url: str) -> dict:
                 "error": "Page instance not available."
             }
         
-        print(f"[Browser Tool - Browse] Navigating to {url}...")
-        await page.goto(url, wait_until='networkidle', timeout=45000)
-        print("[Browser Tool - Browse] Navigation successful. Getting content and screenshot...")
-        
-        # Get text content
-        html_content = await page.content()
-        soup = BeautifulSoup(html_content, 'html.parser')
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
-        text_content = soup.get_text()
-        lines = (line.strip() for line in text_content.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        simplified_text = '\n'.join(chunk for chunk in chunks if chunk)
-        
-        # Get screenshot and resize
-        screenshot_bytes = await page.screenshot(type='png') # Get screenshot as bytes
-        
-        # Resize image using Pillow to reduce size (and cost)
-        # Max width 768px, height will scale proportionally. Quality 85.
-        img = Image.open(BytesIO(screenshot_bytes))
-        max_width = 768 
-        if img.width > max_width:
-            scale_ratio = max_width / img.width
-            new_height = int(img.height * scale_ratio)
-            img = img.resize((max_width, new_height), Image.LANCZOS) # Use LANCZOS for better quality resize
-        
-        # <<< ADDED: Save the image locally for debugging >>>
-        try:
-            debug_screenshot_path = "debug_screenshot.png" 
-            img.save(debug_screenshot_path, format="PNG")
-            print(f"[Browser Tool - Browse] Debug screenshot saved to: {debug_screenshot_path}")
-        except Exception as save_e:
-            print(f"[Browser Tool - Browse] Warning: Could not save debug screenshot: {save_e}")
-        # <<< END ADDED SECTION >>>
-
-        buffered = BytesIO()
-        img.save(buffered, format="PNG", quality=85, optimize=True) # Save resized image to buffer
-        screenshot_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        print(f"[Browser Tool - Browse] Returning text and screenshot (text_len: {len(simplified_text)}, screenshot_size_approx_b64: {len(screenshot_base64)}).")
-        
-        # Truncate text if too long for context, but keep screenshot
-        max_text_length_for_llm = 3000 
-        if len(simplified_text) > max_text_length_for_llm:
-            simplified_text = simplified_text[:max_text_length_for_llm] + "... [Text content truncated for LLM context]"
-
-        return {
-            "text_content": simplified_text,
-            "screenshot_base64": screenshot_base64,
-            "url": page.url # Return current URL as well
-        }
+        return await _capture_page_state(page, navigate_to=url)
         
     except Exception as e:
-        error_message = f"Error browsing {url}: {str(e)}\n{traceback.format_exc()}"
-        print(f"[Browser Tool - Browse] {error_message}")
+        # Timeouts are an expected failure mode; only unexpected errors get a (lazily formatted) traceback
+        logger.error("[Browser Tool - Browse] Error browsing %s: %s", url, e, exc_info=not isinstance(e, PlaywrightTimeoutError))
         current_url = "Unknown"
-        if '_page_instance' in globals() and _page_instance and not _page_instance.is_closed():
-             current_url = _page_instance.url
+        current_page = _current_page.get()
+        if current_page and not current_page.is_closed():
+             current_url = current_page.url
         return {
             "text_content": f"Error: Could not browse {url}. Details: {str(e)}",
             "screenshot_base64": None,
@@ -254,91 +488,126 @@ async def _browse_web_page_internal(url: str) -> dict:
             "url": current_url
         }
 
+async def _first_visible_locator(locators: list, timeout_ms: int = 3000) -> tuple[int, object] | None:
+    """Waits for all locators concurrently and returns (index, locator) of the first one that becomes visible,
+    or None if none do within timeout_ms. When several are visible at once the earliest in the list wins."""
+    tasks = [asyncio.create_task(locator.wait_for(state='visible', timeout=timeout_ms)) for locator in locators]
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [i for i, task in enumerate(tasks) if task in done and task.exception() is None]
+            if succeeded:
+                return succeeded[0], locators[succeeded[0]]
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True) # Reap the losers so none log "exception never retrieved"
+
+# Returns the first selector whose first match is visible (non-empty box, not visibility:hidden), like Locator.wait_for(state='visible').
+# Falsy until then, so page.wait_for_function keeps polling it in-page.
+_FIRST_VISIBLE_SELECTOR_JS = """(selectors) => {
+    for (const selector of selectors) {
+        let el = null;
+        try { el = document.querySelector(selector); } catch (e) { continue; }
+        if (el && el.getClientRects().length && getComputedStyle(el).visibility !== 'hidden') return selector;
+    }
+    return null;
+}"""
+
+async def _click_camera_button(page: Page, timeout_ms: int = 3000) -> bool:
+    """Clicks the 'Search by image' (camera) button using the known deterministic locators, without any LLM help.
+    Each strategy waits up to timeout_ms for its first visible match. Returns True once a click lands, False if none did."""
+    # Strategy 1: Try specific aria-labels (Most reliable)
+    # Plain CSS selectors are checked inside the page in a single polling wait_for_function call, instead of one
+    # Playwright wait per selector; selectors using Playwright's own ">>" syntax are raced with the role locators below
+    logger.debug("[Browser Tool - Click Camera] Probing %d CSS selector strategies in-page...", len(_CAMERA_CSS_SELECTORS))
+    try:
+        handle = await page.wait_for_function(_FIRST_VISIBLE_SELECTOR_JS, arg=list(_CAMERA_CSS_SELECTORS), timeout=timeout_ms)
+        selector = await handle.json_value()
+    except PlaywrightTimeoutError:
+        selector = None
+    if selector:
+        try:
+            await page.locator(selector).first.click(timeout=3000)
+            logger.info("[Browser Tool - Click Camera] Successfully clicked using selector: %s", selector)
+            return True
+        except Exception as e:
+            logger.debug("[Browser Tool - Click Camera] Selector %s was visible but click failed: %s", selector, type(e).__name__)
+
+    # Strategy 2: Try Playwright's get_by_role if CSS failed
+    logger.debug("[Browser Tool - Click Camera] Racing %d get_by_role and %d selector-engine strategies...", len(_CAMERA_ROLE_PATTERNS), len(_CAMERA_ENGINE_SELECTORS))
+    locators = [page.get_by_role(role, name=name_regex).first for role, name_regex in _CAMERA_ROLE_PATTERNS] + [page.locator(selector).first for selector in _CAMERA_ENGINE_SELECTORS]
+    winner = await _first_visible_locator(locators, timeout_ms=timeout_ms)
+    if winner is not None:
+        index, element = winner
+        try:
+            await element.click(timeout=3000)
+            logger.info("[Browser Tool - Click Camera] Successfully clicked using %s", _CAMERA_FALLBACK_STRATEGIES[index])
+            return True
+        except Exception as e:
+            logger.debug("[Browser Tool - Click Camera] %s was visible but click failed: %s", _CAMERA_FALLBACK_STRATEGIES[index], type(e).__name__)
+
+    return False
+
+async def _wait_after_click(page: Page) -> None:
+    """Waits until the upload dialog opened by the camera click has its file input attached, up to UPLOAD_DIALOG_TIMEOUT_MS.
+    Google's pages keep background requests going, so networkidle is not a reliable "dialog ready" signal."""
+    try:
+        await page.wait_for_selector(UPLOAD_DIALOG_READY_SELECTOR, state="attached", timeout=UPLOAD_DIALOG_TIMEOUT_MS)
+    except PlaywrightTimeoutError:
+        logger.debug("[Browser Tool] No %s attached within %d ms after click; continuing.", UPLOAD_DIALOG_READY_SELECTOR, UPLOAD_DIALOG_TIMEOUT_MS)
+
 async def _click_element_by_description_internal(description: str) -> str:
-    print(f"\n[Internal Tool] _click_element_by_description_internal(description='{description}')")
+    logger.debug("[Internal Tool] _click_element_by_description_internal(description=%r)", description)
     try:
         page = await get_page()
         if not page or page.is_closed(): return "Error: No active page."
         
-        print(f"[Browser Tool - Click by Desc] Attempting to click element described as: {description}")
-        
-        # Strategy 1: Try specific aria-labels (Most reliable)
-        possible_selectors = [
-            "div[aria-label='按图搜索']",
-            "div[aria-label='Search by image']",
-            "button[aria-label='按图搜索']",
-            "button[aria-label='Search by image']",
-            "span[aria-label='按图搜索']", # Try span as well
-            "span[aria-label='Search by image']",
-            "div[role='button'][aria-label*='搜索']", # More generic search label
-            "div[role='button'][aria-label*='Search']",
-            "textarea[aria-label='搜索图片'] + div >> internal:control=enter-frame >> div[role='button'][aria-label*='搜索']" # Example complex selector if icon is in sibling div or frame
-        ]
+        logger.debug("[Browser Tool - Click by Desc] Attempting to click element described as: %s", description)
         
-        clicked = False
-        for i, selector in enumerate(possible_selectors):
-            try:
-                print(f"[Browser Tool - Click by Desc] Trying CSS selector strategy #{i+1}: {selector}")
-                element = page.locator(selector).first
-                await element.wait_for(state='visible', timeout=3000) # Shorter timeout for trying many
-                # await element.wait_for(state='enabled', timeout=3000)
-                await element.click(timeout=3000)
-                print(f"[Browser Tool - Click by Desc] Successfully clicked using selector: {selector}")
-                clicked = True
-                break 
-            except Exception as e:
-                # print(f"[Browser Tool - Click by Desc] CSS Selector strategy #{i+1} failed: {selector} - {type(e).__name__}")
-                pass # Silently continue if selector fails
-
-        # Strategy 2: Try Playwright's get_by_role if CSS failed
-        if not clicked:
-            possible_roles_and_names = [
-                ("button", re.compile('按图搜索|Search by image', re.IGNORECASE)),
-                ("link", re.compile('按图搜索|Search by image', re.IGNORECASE)), # Sometimes it might be a link
-                ("button", re.compile('搜索|Search', re.IGNORECASE)) # Generic fallback
-            ]
-            for i, (role, name_regex) in enumerate(possible_roles_and_names):
-                try:
-                    print(f"[Browser Tool - Click by Desc] Trying get_by_role strategy #{i+1}: role={role}, name={name_regex.pattern}")
-                    element = page.get_by_role(role, name=name_regex).first
-                    await element.wait_for(state='visible', timeout=3000)
-                    # await element.wait_for(state='enabled', timeout=3000)
-                    await element.click(timeout=3000)
-                    print(f"[Browser Tool - Click by Desc] Successfully clicked using get_by_role: role={role}, name={name_regex.pattern}")
-                    clicked = True
-                    break
-                except Exception as e:
-                    # print(f"[Browser Tool - Click by Desc] get_by_role strategy #{i+1} failed: {role}/{name_regex.pattern} - {type(e).__name__}")
-                    pass # Silently continue
+        clicked = await _click_camera_button(page, timeout_ms=3000)
 
         if clicked:
-            await page.wait_for_timeout(3000) # Wait after successful click
-            # <<< ADDED: Wait longer and take screenshot after click >>>
-            print("[Browser Tool - Click by Desc] Click successful. Waiting 10s and taking screenshot...")
-            await page.wait_for_timeout(10000) 
-            try:
-                screenshot_path_after_click = "screenshot_after_click.png"
-                await page.screenshot(path=screenshot_path_after_click)
-                print(f"[Browser Tool - Click by Desc] Screenshot after click saved to: {screenshot_path_after_click}")
-            except Exception as ss_e:
-                print(f"[Browser Tool - Click by Desc] Could not save screenshot after click: {ss_e}")
-            # <<< END ADDED SECTION >>>
+            await _wait_after_click(page)
+            if DEBUG_SCREENSHOTS:
+                logger.debug("[Browser Tool - Click by Desc] Click successful. Taking screenshot...")
+                try:
+                    screenshot_path_after_click = "screenshot_after_click.png"
+                    await page.screenshot(path=screenshot_path_after_click)
+                    logger.debug("[Browser Tool - Click by Desc] Screenshot after click saved to: %s", screenshot_path_after_click)
+                except Exception as ss_e:
+                    logger.warning("[Browser Tool - Click by Desc] Could not save screenshot after click: %s", ss_e)
             return f"Successfully clicked the element described as '{description}' using a likely locator."
         else:
-            print("[Browser Tool - Click by Desc] All tested strategies failed.")
-            raise Exception("Could not find or click the element based on the description using any known strategy.")
+            # Expected failure: no traceback to format, just report it once
+            logger.error("[Browser Tool - Click by Desc] All tested strategies failed for: %s", description)
+            raise LookupError("Could not find or click the element based on the description using any known strategy.")
 
     except Exception as e:
-        error_message = f"Error clicking element described as '{description}': {str(e)}\n{traceback.format_exc()}"
-        print(f"[Browser Tool - Click by Desc] {error_message}")
-        if '_page_instance' in globals() and _page_instance and not _page_instance.is_closed():
+        logger.error("[Browser Tool - Click by Desc] Error clicking element described as '%s': %s", description, e,
+                     exc_info=not isinstance(e, (LookupError, PlaywrightTimeoutError)))
+        current_page = _current_page.get()
+        if current_page and not current_page.is_closed():
             try:
-                await _page_instance.screenshot(path="error_screenshot_click_desc_failed.png")
-                print("[Browser Tool - Click by Desc] Saved screenshot on error to error_screenshot_click_desc_failed.png")
+                await current_page.screenshot(path="error_screenshot_click_desc_failed.png")
+                logger.info("[Browser Tool - Click by Desc] Saved screenshot on error to error_screenshot_click_desc_failed.png")
             except Exception as ss_e:
-                print(f"[Browser Tool - Click by Desc] Could not save screenshot on error: {ss_e}")
+                logger.warning("[Browser Tool - Click by Desc] Could not save screenshot on error: %s", ss_e)
         return f"Error: Could not click element described as '{description}'. Details: {str(e)}"
 
+_OUTER_HTML_PREVIEW_JS = "el => (el.outerHTML || '').slice(0, 256)"
+# Common selectors for file input elements, as one CSS selector list; the locator's .first is the earliest match in DOM order
+_FILE_INPUT_SELECTORS = (
+    "input[type='file']", # Also covers the old "form input[type='file']" / "div input[type='file']" / XPath variants
+    "[data-testid='file-input']", # Common test ID
+    "input[name='image']", # Common name
+    "input[name='file']",
+)
+_FILE_INPUT_SELECTOR_UNION = ", ".join(_FILE_INPUT_SELECTORS)
+FILE_INPUT_TIMEOUT_MS = 5000
+
 async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
     """
     Attempts to upload a file using a file input element found by various strategies.
@@ -357,7 +626,7 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
         logger.error(f"[Browser Tool - Upload Internal] File not found: {file_path}")
         return {
             "upload_status": f"Upload failed: File not found at {file_path}",
-            "current_url": page.url, "page_content": await page.content(), "screenshot": None,
+            "current_url": page.url, "page_content": None, "screenshot": None,
             "error_message": f"Upload failed: File not found at {file_path}"
         }
 
@@ -366,53 +635,29 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
     file_input_el = None # Initialize file_input_el
 
     try:
-        # Common selectors for file input elements
-        file_input_selectors = [
-            "input[type='file']",
-            "//input[@type='file']", # XPath version
-            "form input[type='file']",
-            "div input[type='file']",
-            "[data-testid='file-input']", # Common test ID
-            "input[name='image']", # Common name
-            "input[name='file']"
-        ]
-
-        logger.info(f"[Browser Tool - Upload Internal] Waiting for a file input element to become available...")
-
-        for i, selector in enumerate(file_input_selectors):
-            logger.debug(f"[Browser Tool - Upload Internal] Trying file input selector #{i+1}: {selector}")
-            try:
-                await page.wait_for_selector(selector, state="attached", timeout=2000)
-                file_input_el = page.locator(selector).first
-                # --- CRITICAL FIX: Ensure NO await here ---
-                if file_input_el.is_attached():
-                     logger.info(f"[Browser Tool - Upload Internal] Found file input element with selector: {selector}")
-                     break
-                else:
-                     file_input_el = None # Reset if found but not attached
-            except PlaywrightTimeoutError:
-                logger.debug(f"[Browser Tool - Upload Internal] Selector {selector} not found or not attached quickly.")
-                file_input_el = None # Reset on timeout
-                continue
-            except Exception as e:
-                logger.warning(f"[Browser Tool - Upload Internal] Error checking selector {selector}: {e}")
-                file_input_el = None # Reset on other errors
-                continue
+        # One attached-wait on the unioned selector list instead of a 2s wait per alternative
+        logger.info("[Browser Tool - Upload Internal] Waiting for a file input element to become available...")
+        try:
+            await page.wait_for_selector(_FILE_INPUT_SELECTOR_UNION, state="attached", timeout=FILE_INPUT_TIMEOUT_MS)
+            file_input_el = page.locator(_FILE_INPUT_SELECTOR_UNION).first
+            logger.info("[Browser Tool - Upload Internal] Found file input element matching: %s", _FILE_INPUT_SELECTOR_UNION)
+        except PlaywrightTimeoutError:
+            logger.debug("[Browser Tool - Upload Internal] No file input attached within %d ms.", FILE_INPUT_TIMEOUT_MS)
 
-        # Check if file_input_el was successfully found and is attached
-        # --- CRITICAL FIX: Ensure NO await here ---
-        if not file_input_el or not file_input_el.is_attached():
+        if file_input_el is None:
             logger.error("[Browser Tool - Upload Internal] No file input element found or attached using common selectors.")
             error_message = "Upload failed: No suitable file input element found on the page."
         else:
-            # Log the outerHTML *before* trying to interact, helps debugging
-            try:
-                 outer_html = await file_input_el.evaluate('element => element.outerHTML')
-                 logger.info(f"[Browser Tool - Upload Internal] Using file input element: {outer_html}")
-            except Exception as eval_e:
-                 logger.warning(f"[Browser Tool - Upload Internal] Could not evaluate outerHTML for found input: {eval_e}")
-                 logger.info(f"[Browser Tool - Upload Internal] Using file input element found with selector, but could not get HTML.")
+            # Log the outerHTML *before* trying to interact, helps debugging (skipped entirely when INFO is not emitted)
+            if logger.isEnabledFor(logging.INFO):
+                try:
+                     outer_html = await file_input_el.evaluate(_OUTER_HTML_PREVIEW_JS) # Truncated in-page, before it crosses the bridge
+                     logger.info("[Browser Tool - Upload Internal] Using file input element: %s", outer_html)
+                except Exception as eval_e:
+                     logger.warning("[Browser Tool - Upload Internal] Could not evaluate outerHTML for found input: %s", eval_e)
+                     logger.info("[Browser Tool - Upload Internal] Using file input element found with selector, but could not get HTML.")
 
+            url_before_upload = page.url
             await file_input_el.set_input_files(file_path)
             logger.info(f"[Browser Tool - Upload Internal] set_input_files(\'{file_path}\') called successfully.")
             upload_successful = True
@@ -422,12 +667,18 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
         logger.error(f"[Browser Tool - Upload Internal] Timeout error during upload attempt: {e}")
         error_message = f"Upload failed due to timeout: {e}"
     except Exception as e:
-        logger.error(f"[Browser Tool - Upload Internal] General error during upload attempt: {e}\\n{traceback.format_exc()}") # Log traceback too
+        logger.exception("[Browser Tool - Upload Internal] General error during upload attempt: %s", e) # Traceback is formatted only if a handler emits it
         error_message = f"Upload failed: {e}"
 
     # --- Return logic ---
     if upload_successful:
-        await asyncio.sleep(2) # Give page a moment to react
+        # Google navigates to the results page once the upload finishes; return as soon as the URL changes
+        try:
+            await page.wait_for_url(lambda url: url != url_before_upload, timeout=RESULTS_URL_TIMEOUT_MS)
+            if not _RESULTS_URL_RE.search(page.url):
+                logger.info("[Browser Tool - Upload Internal] Navigated to an unrecognised results URL: %s", page.url)
+        except PlaywrightTimeoutError:
+            logger.warning("[Browser Tool - Upload Internal] No navigation within %d ms after upload (current URL: %s). Capturing anyway.", RESULTS_URL_TIMEOUT_MS, page.url)
         logger.info("[Browser Tool - Upload Internal] Capturing page state after file selection...")
         capture_data = await _capture_current_page() # Assumes _capture_current_page is defined globally
         # Check if capture itself failed
@@ -448,6 +699,7 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
                  "current_url": capture_data.get("current_url"),
                  "page_content": capture_data.get("page_content"),
                  "screenshot": capture_data.get("screenshot"),
+                 "screenshot_hash": capture_data.get("screenshot_hash"),
                  "error_message": None
              }
     else:
@@ -455,7 +707,8 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
         logger.info("[Browser Tool - Upload Internal] Upload failed. Capturing current page state for debugging...")
         current_page_state = await _capture_current_page()
         # Log the state capture result along with the original upload error
-        logger.debug(f"[Browser Tool - Upload Internal] State capture after failed upload result: {filter_screenshot_from_state(current_page_state)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[Browser Tool - Upload Internal] State capture after failed upload result: %s", filter_screenshot_from_state(current_page_state))
         return {
             "upload_status": "Upload failed.",
             "current_url": current_page_state.get("current_url", page.url if page and not page.is_closed() else None),
@@ -465,546 +718,555 @@ async def _upload_file_internal(locator_or_text: str, file_path: str) -> dict:
         }
 
 # --- LangGraph State Definition ---
-class AgentState(TypedDict):
-    task: str
-    image_path: str
-    current_url: str
-    page_content: str
-    screenshot: str
-    error_message: str | None
-    analysis_result: str
+class UploadStatus(enum.IntEnum):
+    """Outcome of perform_upload, routed on directly instead of matching _upload_file_internal's status text."""
+    NOT_ATTEMPTED = 0
+    INITIATED = 1 # File handed to the page's file input and the resulting page captured
+    FAILED = 2
+
+@dataclasses.dataclass(slots=True)
+class AgentState:
+    task: str = ""
+    image_path: str = ""
+    current_url: str | None = None
+    page_content: str | None = None
+    screenshot: str | None = None
+    screenshot_hash: str | None = None # screenshot_digest() of the raw bytes behind `screenshot`, when the capture computed it
+    error_message: str | None = None
+    analysis_result: str = ""
+    upload_target_kind: Literal["selector", "description", "none"] = "none" # Set once by analyze_upload_dialog from analysis_result
+    upload_status: UploadStatus = UploadStatus.NOT_ATTEMPTED
+    audit_trace: Annotated[list[str], operator.add] = dataclasses.field(default_factory=list) # One entry per node run, appended by @audited
+
+def audited(name: str):
+    """Node decorator factory: appends one "<name> -> <next step>" entry to audit_trace for every run of the node.
+    `name` must be the node's name in the graph (as passed to add_node), so entries match the goto targets.
+    functools.wraps keeps the node's Command[Literal[...]] annotation, which LangGraph reads to draw the graph's edges."""
+    def decorator(node_fn):
+        @functools.wraps(node_fn)
+        async def wrapper(state: AgentState):
+            result = await node_fn(state)
+            if isinstance(result, Command):
+                update = dict(result.update or {})
+                error = update.get("error_message")
+                update["audit_trace"] = [f"{name} -> {result.goto}" + (f" (error: {error})" if error else "")]
+                return Command(update=update, goto=result.goto)
+            update = dict(result or {})
+            error = update.get("error_message")
+            update["audit_trace"] = [f"{name}" + (f" (error: {error})" if error else "")]
+            return update
+
+        return wrapper
+    return decorator
+
+# --- Vision Prompts ---
+# Built once at import; the nodes only fill in the {variables}. Page text and base64 are substituted as values,
+# so braces inside them are never parsed as template slots.
+VISION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are an expert visual analysis assistant. Your task is to analyze the provided screenshot of a webpage (Google Images). "
+               "Your goal is to locate the 'Search by image' camera icon."),
+    ("human", [
+        {"type": "text", "text": "Look carefully at this screenshot of the page:"},
+        {
+            "type": "image_url",
+            "image_url": {"url": "data:image/jpeg;base64,{screenshot_b64}", "detail": VISION_IMAGE_DETAIL}
+        },
+        {"type": "text", "text": "\n\nBased ONLY on the screenshot, look INSIDE the main search bar, specifically on the RIGHT side. "
+                                 "You should see a microphone icon and a camera icon. Identify the CAMERA icon. "
+                                 "If you see the camera icon, respond ONLY with a concise visual description (e.g., 'Camera icon inside search bar on the right'). "
+                                 "If you CANNOT visually find the camera icon inside the search bar, respond ONLY with 'Camera icon not visually found'."}
+    ])
+])
+VISION_CHAIN = VISION_PROMPT | llm.bind(max_tokens=64) # Answer is one short phrase
+
+UPLOAD_DIALOG_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are an expert visual analysis assistant focused on web automation. "
+               "The user has already clicked a 'search by image' (camera) icon, and the screenshot you are seeing shows the MODAL DIALOG that appeared for uploading an image. "
+               "Your ONLY task is to analyze the elements WITHIN THIS MODAL DIALOG. IGNORE any background elements like search bars or other icons that are NOT part of this dialog. "
+               "Inside this dialog, find the clickable element (e.g., a link, a button, or an area that looks like an <input type=\"file\">) that allows the user to SELECT A FILE from their computer to upload. "
+               "Do NOT look for a search button or an image paste area. Focus on the file SELECTION/UPLOAD element."),
+    ("human", [
+        {"type": "text", "text": """{page_text_block}Screenshot of the UPLOAD DIALOG (URL: {current_url}, focus ONLY on this dialog):
+It should contain options like 'upload a file', 'select file', '粘贴图片网址', '或上传文件'."""},
+        {
+            "type": "image_url",
+            "image_url": {"url": "data:image/jpeg;base64,{screenshot_b64}", "detail": VISION_IMAGE_DETAIL}
+        },
+        {"type": "text", "text": "\n\nBased on the screenshot and text of the MODAL DIALOG, what is the most appropriate and robust CSS selector for the file UPLOAD link/button (e.g., `a.upload-link`, `button[aria-label='Upload file']`, `input[type='file']`)? "
+                                 "If you can identify it clearly, provide ONLY the CSS selector string. "
+                                 "If you are less certain about a CSS selector but can identify the exact text of the element (e.g., '上传文件' or 'upload a file'), provide ONLY that exact text string. "
+                                 "If you cannot find a suitable element for file upload within the dialog, respond with 'File upload element not found in dialog'."}
+    ])
+])
+UPLOAD_DIALOG_CHAIN = UPLOAD_DIALOG_PROMPT | llm.bind(max_tokens=128) | StrOutputParser() # Answer is a CSS selector or element text
+
+RESULTS_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are an expert visual analysis assistant. Your task is to analyze the provided screenshot and text from a Google Lens search results page. "
+               "Focus on the section titled '包含匹配图片的页面' (Pages that include matching images). "
+               "Extract all the source URLs listed under that section. "
+               "Format your response clearly, starting with 'Visually similar images found.', then mentioning the section title found, and finally listing the extracted URLs under 'Found URLs:'."),
+    ("human", [
+        {"type": "text", "text": """Relevant text from the results page (URL: {current_url}):
+```
+{page_text}```
+
+Screenshot of the results page:"""},
+        {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,{screenshot_b64}", "detail": VISION_IMAGE_DETAIL}},
+        {"type": "text", "text": "\n\nPlease analyze the screenshot and text, specifically find the section '包含匹配图片的页面' and list all the source URLs shown under it."}
+    ])
+])
+RESULTS_CHAIN = RESULTS_PROMPT | llm.bind(max_tokens=1000) | StrOutputParser() # Room for a list of source URLs
+
+# --- Vision LLM Response Cache ---
+# The Google Images page and upload dialog look the same from run to run, so vision answers are cached on disk keyed by
+# (screenshot hash, prompt id). Bump a prompt id whenever its prompt text changes so stale answers are not reused.
+VISION_PROMPT_ID = f"camera_icon_v2:{VISION_IMAGE_DETAIL}" # The detail level changes what the model sees, so it is part of the id
+UPLOAD_DIALOG_PROMPT_ID = f"upload_dialog_v1:{VISION_IMAGE_DETAIL}"
+LLM_CACHE_DIR = ".agent_cache"
+LLM_CACHE_TTL_SECONDS = 86400
+llm_cache = diskcache.Cache(LLM_CACHE_DIR) if diskcache is not None else None
+# In-process LRU in front of the disk cache: retries within a run skip both the LLM and the disk/pickle round trip
+_ANALYSIS_MEMO_MAX_ENTRIES = 128
+_ANALYSIS_MEMO: OrderedDict[str, str] = OrderedDict()
+
+def _llm_cache_key(screenshot_hash: str, prompt_id: str) -> str:
+    return screenshot_hash + ":" + prompt_id
+
+async def _cached_analysis(screenshot_hash: str | None, screenshot_b64: str, prompt_id: str, compute) -> str:
+    """Returns the memoized/cached LLM answer for this screenshot/prompt, or awaits compute() and stores its result.
+    screenshot_hash is the capture's screenshot_digest(); if the state has none it is derived from screenshot_b64."""
+    key = _llm_cache_key(screenshot_hash or screenshot_digest(b64codec.b64decode(screenshot_b64)), prompt_id)
+    memo_hit = _ANALYSIS_MEMO.get(key)
+    if memo_hit is not None:
+        _ANALYSIS_MEMO.move_to_end(key)
+        logger.info("[LLM Cache] Memo hit for %s", prompt_id)
+        return memo_hit
+
+    result = llm_cache.get(key) if llm_cache is not None else None
+    if result is not None:
+        logger.info("[LLM Cache] Hit for %s", prompt_id)
+    else:
+        result = await compute()
+        if llm_cache is not None:
+            llm_cache.set(key, result, expire=LLM_CACHE_TTL_SECONDS)
+
+    _ANALYSIS_MEMO[key] = result
+    if len(_ANALYSIS_MEMO) > _ANALYSIS_MEMO_MAX_ENTRIES:
+        _ANALYSIS_MEMO.popitem(last=False) # Evict the least recently used answer
+    return result
 
 # --- LangGraph Nodes Definitions ---
 
-async def start_browse_node(state: AgentState) -> AgentState:
+@audited("start_browse")
+async def start_browse_node(state: AgentState) -> dict:
     """Node to initiate the browsing process by navigating to Google Images."""
-    print("--- Executing Node: start_browse ---")
+    logger.info("--- Executing Node: start_browse ---")
     url_to_browse = "https://images.google.com/"
     browse_result = await _browse_web_page_internal(url_to_browse)
     
     if browse_result.get("error"):
-        print(f"Error in start_browse: {browse_result['error']}")
-        state["error_message"] = browse_result["error"]
-    else:
-        state["current_url"] = browse_result.get("url")
-        state["page_content"] = browse_result.get("text_content")
-        state["screenshot"] = browse_result.get("screenshot_base64")
-        state["error_message"] = None # Clear previous errors
+        logger.error("Error in start_browse: %s", browse_result["error"])
+        return {"error_message": browse_result["error"]}
+    return {
+        "current_url": browse_result.get("url"),
+        "page_content": browse_result.get("text_content"),
+        "screenshot": browse_result.get("screenshot_base64"),
+        "screenshot_hash": browse_result.get("screenshot_hash"),
+        "error_message": None, # Clear previous errors
+    }
+
+@audited("fast_click")
+async def fast_click_node(state: AgentState) -> Command[Literal["capture_upload_dialog_page", "analyze_vision"]]:
+    """Node that tries the deterministic camera-button locators before paying for a vision LLM call.
+    On success the graph skips analyze_vision/click and goes straight to capturing the upload dialog."""
+    logger.info("--- Executing Node: fast_click ---")
+    if state.error_message:
+        return Command(goto="analyze_vision") # Let analyze_vision report the start_browse failure as before
+
+    page = await get_page()
+    if not page or page.is_closed():
+        return Command(goto="analyze_vision")
+
+    try:
+        clicked = await _click_camera_button(page, timeout_ms=FAST_CLICK_TIMEOUT_MS)
+    except Exception as e:
+        logger.warning("[Fast Click Node] Deterministic probe failed, falling back to vision: %s", e)
+        clicked = False
+
+    if not clicked:
+        logger.info("Decision: %s -> %s", "fast click missed", "analyze_vision")
+        return Command(goto="analyze_vision")
 
-    return state
+    await _wait_after_click(page)
+    logger.info("Decision: %s -> %s", "camera button clicked by known locator", "capture_upload_dialog_page")
+    return Command(update={"analysis_result": "Camera icon clicked via known locator", "error_message": None}, goto="capture_upload_dialog_page")
 
 # --- Placeholder Nodes (to be implemented) ---
-async def analyze_vision_node(state: AgentState) -> AgentState:
-    """Node to call LLM to analyze screenshot and text to find the next action."""
-    print("--- Executing Node: analyze_vision ---")
+# Fixed analyze_vision answers that end the graph; everything else goes on to the click node
+_VISION_ROUTES: dict[str, Literal["click", "__end__"]] = {"Camera icon not visually found": END}
+
+@audited("analyze_vision")
+async def analyze_vision_node(state: AgentState) -> Command[Literal["click", "__end__"]]:
+    """Node to call LLM to analyze the screenshot to find the next action, then route to click or end."""
+    logger.info("--- Executing Node: analyze_vision ---")
     
-    screenshot_b64 = state.get("screenshot")
-    text_content = state.get("page_content", "")
-    task_prompt = state.get("task", "Find source URL for an image.") # Use original task for context
+    screenshot_b64 = state.screenshot
 
     if not screenshot_b64:
-        print("Error: No screenshot available for analysis.")
-        state["error_message"] = "No screenshot available for analysis."
-        state["analysis_result"] = "Camera icon not visually found" # Treat as not found
-        return state
-
-    # Construct the prompt for the LLM
-    # We need to guide it to perform step 3 of our conceptual plan
-    vision_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are an expert visual analysis assistant. Your task is to analyze the provided screenshot and text from a webpage (Google Images). "
-                   "Your goal is to locate the 'Search by image' camera icon."),
-        ("human", [
-            {"type": "text", "text": f"Here is the relevant text from the page:\n```\n{text_content[:1000]}...```\n\n" # Limit text length
-                                      "Now, look carefully at this screenshot of the page:"},
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{screenshot_b64}"}
-            },
-            {"type": "text", "text": "\n\nBased ONLY on the screenshot, look INSIDE the main search bar, specifically on the RIGHT side. "
-                                      "You should see a microphone icon and a camera icon. Identify the CAMERA icon. "
-                                      "If you see the camera icon, respond ONLY with a concise visual description (e.g., 'Camera icon inside search bar on the right'). "
-                                      "If you CANNOT visually find the camera icon inside the search bar, respond ONLY with 'Camera icon not visually found'."}
-        ])
-    ])
-    
-    # Chain the prompt and LLM
-    chain = vision_prompt | llm
-    
+        logger.error("No screenshot available for analysis.")
+        return Command(update={"error_message": "No screenshot available for analysis.",
+                               "analysis_result": "Camera icon not visually found"}, goto=END) # Treat as not found
+
     try:
-        print("Invoking LLM for visual analysis...")
-        response = await chain.ainvoke({})
-        analysis = response.content.strip()
-        print(f"LLM Analysis Result: {analysis}")
+        logger.debug("Invoking LLM for visual analysis...")
+        async def invoke_vision() -> str:
+            # The answer must come from the screenshot alone, so the page text is not sent
+            response = await VISION_CHAIN.ainvoke({"screenshot_b64": screenshot_b64})
+            return response.content.strip()
+        analysis = await _cached_analysis(state.screenshot_hash, screenshot_b64, VISION_PROMPT_ID, invoke_vision)
+        logger.info("LLM Analysis Result: %s", analysis)
         
         # Validate analysis result format slightly
         if analysis.startswith("Camera icon") or analysis == "Camera icon not visually found":
-            state["analysis_result"] = analysis
-            state["error_message"] = None
+            update = {"analysis_result": analysis, "error_message": None}
         else:
             # If LLM gives unexpected output, treat as error/not found for now
-            print(f"Warning: LLM analysis result unexpected format: {analysis}")
-            state["analysis_result"] = "Camera icon not visually found" 
-            state["error_message"] = "LLM analysis format unexpected."
+            logger.warning("LLM analysis result unexpected format: %s", analysis)
+            update = {"analysis_result": "Camera icon not visually found", "error_message": "LLM analysis format unexpected."}
             
     except Exception as e:
-        print(f"Error during LLM visual analysis: {e}")
-        print(traceback.format_exc())
-        state["error_message"] = f"LLM analysis failed: {e}"
-        state["analysis_result"] = "Camera icon not visually found" # Default on error
-
-    return state
-
-async def click_node(state: AgentState) -> dict:
+        logger.exception("Error during LLM visual analysis: %s", e)
+        update = {"analysis_result": "Camera icon not visually found", "error_message": f"LLM analysis failed: {e}"} # Default on error
+    # The screenshot has been consumed; drop it so it isn't carried through (and checkpointed with) every later step
+    update.update(screenshot=None, screenshot_hash=None)
+
+    if update["error_message"]:
+        logger.info("Decision: %s -> %s", update["error_message"], END)
+        return Command(update=update, goto=END)
+    goto = _VISION_ROUTES.get(update["analysis_result"], "click") # Any other answer is a description of the icon to click
+    logger.info("Decision: camera analysis %r -> %s", update["analysis_result"], goto)
+    return Command(update=update, goto=goto)
+
+@audited("click")
+async def click_node(state: AgentState) -> Command[Literal["capture_upload_dialog_page", "__end__"]]:
     """Node to perform the click action based on analysis result."""
-    print("--- Executing Node: click (Placeholder) ---")
-    description_or_selector = state.get("analysis_result")
+    logger.info("--- Executing Node: click ---")
+    description_or_selector = state.analysis_result
     if description_or_selector and description_or_selector != "Camera icon not visually found":
         click_result = await _click_element_by_description_internal(description_or_selector)
-        if "Error" in click_result:
-            # <<< Return only the update dictionary >>>
-            return {"error_message": click_result} 
-        else:
-             # <<< Return only the update dictionary >>>
-             return {"error_message": None} 
+        error_msg = click_result if "Error" in click_result else None
+    elif not description_or_selector:
+        error_msg = "Analysis result missing for click node."
     else:
         error_msg = "No valid target description/selector provided for clicking."
-        if not description_or_selector:
-             error_msg = "Analysis result missing for click node."
-        # <<< Return only the update dictionary >>>
-        return {"error_message": error_msg} 
-    # The implicit return state is removed, we now explicitly return update dicts
 
-async def upload_browse_node(state: AgentState) -> AgentState:
+    if error_msg:
+        logger.info("Decision: click (to open dialog) failed: %s -> %s", error_msg, END)
+        return Command(update={"error_message": error_msg}, goto=END)
+    logger.info("Decision: %s -> %s", "click (to open dialog) successful", "capture_upload_dialog_page")
+    return Command(update={"error_message": None}, goto="capture_upload_dialog_page")
+
+@audited("capture_upload_dialog_page")
+async def upload_browse_node(state: AgentState) -> dict:
     """Node to capture the page state after clicking, expecting the upload dialog.
     This node DOES NOT navigate, it captures the current page."""
-    print("--- Executing Node: upload_browse ---")
+    logger.info("--- Executing Node: upload_browse ---")
     try:
         page = await get_page()
         if not page or page.is_closed():
-            state["error_message"] = "Error: Page instance not available for upload_browse."
-            state["page_content"] = None
-            state["screenshot"] = None
-            return state
-
-        print("[Upload Browse Node] Page active. Getting current content and screenshot...")
-        
-        # Get text content (similar to _browse_web_page_internal but without goto)
-        html_content = await page.content()
-        soup = BeautifulSoup(html_content, 'html.parser')
-        for script_or_style in soup(["script", "style"]):
-            script_or_style.decompose()
-        text_content = soup.get_text()
-        lines = (line.strip() for line in text_content.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        simplified_text = '\n'.join(chunk for chunk in chunks if chunk)
-        
-        # Get screenshot and resize (similar to _browse_web_page_internal)
-        screenshot_bytes = await page.screenshot(type='png')
-        img = Image.open(BytesIO(screenshot_bytes))
-        max_width = 768
-        if img.width > max_width:
-            scale_ratio = max_width / img.width
-            new_height = int(img.height * scale_ratio)
-            img = img.resize((max_width, new_height), Image.LANCZOS)
-        
-        # Save a debug screenshot specifically for this node
-        try:
-            debug_upload_dialog_path = "debug_upload_dialog_screenshot.png"
-            img.save(debug_upload_dialog_path, format="PNG")
-            print(f"[Upload Browse Node] Debug screenshot for upload dialog saved to: {debug_upload_dialog_path}")
-        except Exception as save_e:
-            print(f"[Upload Browse Node] Warning: Could not save debug screenshot for upload dialog: {save_e}")
-
-        buffered = BytesIO()
-        img.save(buffered, format="PNG", quality=85, optimize=True)
-        screenshot_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        print(f"[Upload Browse Node] Captured text and screenshot (text_len: {len(simplified_text)}, screenshot_size_approx_b64: {len(screenshot_base64)}).")
+            return {
+                "error_message": "Error: Page instance not available for upload_browse.",
+                "page_content": None,
+                "screenshot": None,
+                "screenshot_hash": None,
+            }
 
-        max_text_length_for_llm = 3000
-        if len(simplified_text) > max_text_length_for_llm:
-            simplified_text = simplified_text[:max_text_length_for_llm] + "... [Text content truncated for LLM context]"
+        # The upload dialog is identified from the screenshot alone, so skip the HTML fetch + text extraction
+        logger.debug("[Upload Browse Node] Page active. Getting current screenshot...")
+        capture = await _capture_page_state(page, capture_text=False, debug_screenshot_path="debug_upload_dialog_screenshot.jpg")
 
-        state["current_url"] = page.url # Update current URL just in case, though it shouldn't change
-        state["page_content"] = simplified_text
-        state["screenshot"] = screenshot_base64
-        state["error_message"] = None
+        return {
+            "current_url": capture["url"], # Update current URL just in case, though it shouldn't change
+            "page_content": capture["text_content"],
+            "screenshot": capture["screenshot_base64"],
+            "screenshot_hash": capture["screenshot_hash"],
+            "error_message": None,
+        }
 
     except Exception as e:
-        error_message = f"Error in upload_browse_node: {str(e)}\n{traceback.format_exc()}"
-        print(f"[Upload Browse Node] {error_message}")
-        state["error_message"] = str(e)
+        logger.error("[Upload Browse Node] Error in upload_browse_node: %s", e, exc_info=not isinstance(e, PlaywrightTimeoutError))
         # Optionally try to get URL even on error
         current_url_on_error = "Unknown"
-        if '_page_instance' in globals() and _page_instance and not _page_instance.is_closed():
-             current_url_on_error = _page_instance.url
-        state["current_url"] = current_url_on_error
-        state["page_content"] = None
-        state["screenshot"] = None # Ensure screenshot is None on error
-        
-    return state
+        current_page = _current_page.get()
+        if current_page and not current_page.is_closed():
+             current_url_on_error = current_page.url
+        return {
+            "error_message": str(e),
+            "current_url": current_url_on_error,
+            "page_content": None,
+            "screenshot": None, # Ensure screenshot is None on error
+            "screenshot_hash": None,
+        }
+
+# Where analyze_upload_dialog sends each kind of answer: only a locator/short element text can be uploaded to
+_UPLOAD_TARGET_ROUTES = {"selector": "perform_upload", "description": END, "none": END}
+# Patterns for _classify_upload_target, compiled once and matched case-insensitively without lowering the answer
+_UPLOAD_REJECT_RE = re.compile(r"not found|error", re.IGNORECASE)
+_ICON_RE = re.compile(r"icon", re.IGNORECASE)
+
+def _classify_upload_target(analysis_result: str | None) -> Literal["selector", "description", "none"]:
+    """Classifies the upload-dialog LLM answer once, so routing dispatches on the verdict instead of re-parsing text."""
+    if not analysis_result or _UPLOAD_REJECT_RE.search(analysis_result):
+        return "none"
+
+    # Heuristic to accept short text as potential locators
+    cleaned_result = analysis_result.strip()
+    if cleaned_result.startswith("`") and cleaned_result.endswith("`"):
+        cleaned_result = cleaned_result[1:-1].strip()
 
-async def analyze_upload_dialog_node(state: AgentState) -> AgentState:
-    """Node to analyze the screenshot of the upload dialog and find the upload element selector."""
-    print("--- Executing Node: analyze_upload_dialog ---")
+    # Consider it a likely locator if it's not clearly a long description
+    # Heuristic: Fewer than 4 words AND does not contain 'icon' (which was our previous failure mode); maxsplit stops at the 4th word
+    is_likely_locator = bool(cleaned_result) and len(cleaned_result.split(maxsplit=3)) < 4 and not _ICON_RE.search(cleaned_result)
+    return "selector" if is_likely_locator else "description"
+
+@audited("analyze_upload_dialog")
+async def analyze_upload_dialog_node(state: AgentState) -> Command[Literal["perform_upload", "__end__"]]:
+    """Node to analyze the screenshot of the upload dialog and find the upload element selector.
+    Routes to perform_upload only when the answer is classified as a locator or short element text."""
+    logger.info("--- Executing Node: analyze_upload_dialog ---")
     page = await get_page()
     if not page or page.is_closed():
-        state["error_message"] = "Error: Page instance not available for upload dialog analysis."
-        state["analysis_result"] = "Error: Missing input for analysis."
-        return state
-
-    text_content = state.get("page_content")
-    screenshot_b64 = state.get("screenshot")
-    current_url = state.get("current_url") # For context
-
-    if not text_content or not screenshot_b64:
-        state["error_message"] = "Error: Missing page content or screenshot for upload dialog analysis."
-        state["analysis_result"] = "Error: Missing input for analysis."
-        return state
-
-    # <<< MODIFIED SYSTEM AND HUMAN PROMPT BELOW >>>
-    vision_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are an expert visual analysis assistant focused on web automation. "
-                   "The user has already clicked a 'search by image' (camera) icon, and the screenshot you are seeing shows the MODAL DIALOG that appeared for uploading an image. "
-                   "Your ONLY task is to analyze the elements WITHIN THIS MODAL DIALOG. IGNORE any background elements like search bars or other icons that are NOT part of this dialog. "
-                   "Inside this dialog, find the clickable element (e.g., a link, a button, or an area that looks like an <input type=\"file\">) that allows the user to SELECT A FILE from their computer to upload. "
-                   "Do NOT look for a search button or an image paste area. Focus on the file SELECTION/UPLOAD element."),
-        ("human", [
-            {"type": "text", "text": f"""Here is the relevant text from the page dialog (URL: {current_url}):
+        return Command(update={"error_message": "Error: Page instance not available for upload dialog analysis.",
+                               "analysis_result": "Error: Missing input for analysis.", "upload_target_kind": "none"}, goto=END)
+
+    text_content = state.page_content
+    screenshot_b64 = state.screenshot
+    current_url = state.current_url # For context
+
+    # Page text is optional here (upload_browse_node skips it); the screenshot is what the LLM actually needs
+    if not screenshot_b64:
+        return Command(update={"error_message": "Error: Missing screenshot for upload dialog analysis.",
+                               "analysis_result": "Error: Missing input for analysis.", "upload_target_kind": "none"}, goto=END)
+
+    page_text_block = ""
+    if text_content:
+        page_text_block = f"""Here is the relevant text from the page dialog:
 ```
-{text_content[:1000]}...```
+{trim_to_tokens(text_content, PROMPT_TEXT_SNIPPET_TOKENS)}```
 
-Screenshot of the UPLOAD DIALOG (focus ONLY on this dialog):
-It should contain options like 'upload a file', 'select file', '粘贴图片网址', '或上传文件'."""},
-            {
-                "type": "image_url",
-                "image_url": {"url": f"data:image/png;base64,{screenshot_b64}"}
-            },
-            {"type": "text", "text": "\n\nBased on the screenshot and text of the MODAL DIALOG, what is the most appropriate and robust CSS selector for the file UPLOAD link/button (e.g., `a.upload-link`, `button[aria-label='Upload file']`, `input[type='file']`)? "
-                                      "If you can identify it clearly, provide ONLY the CSS selector string. "
-                                      "If you are less certain about a CSS selector but can identify the exact text of the element (e.g., '上传文件' or 'upload a file'), provide ONLY that exact text string. "
-                                      "If you cannot find a suitable element for file upload within the dialog, respond with 'File upload element not found in dialog'."}
-        ])
-    ])
-    # <<< END MODIFIED PROMPT >>>
+"""
 
-    print("[Analyze Upload Dialog Node] Sending request to LLM for vision analysis of the upload dialog...")
-    llm = ChatOpenAI(model="gpt-4o", temperature=0, max_tokens=250) # Correctly initialize LLM
-    chain = vision_prompt | llm | StrOutputParser()
-    
+    logger.debug("[Analyze Upload Dialog Node] Sending request to LLM for vision analysis of the upload dialog...")
     try:
-        analysis_result = await chain.ainvoke({})
-        state["analysis_result"] = analysis_result
-        state["error_message"] = None # Clear previous errors
-        print(f"[Analyze Upload Dialog Node] LLM Analysis Result:\n{analysis_result}")
+        analysis_result = await _cached_analysis(state.screenshot_hash, screenshot_b64, UPLOAD_DIALOG_PROMPT_ID, lambda: UPLOAD_DIALOG_CHAIN.ainvoke({
+            "page_text_block": page_text_block,
+            "current_url": current_url,
+            "screenshot_b64": screenshot_b64,
+        }))
+        logger.info("[Analyze Upload Dialog Node] LLM Analysis Result:\n%s", analysis_result)
     except Exception as e:
-        print(f"[Analyze Upload Dialog Node] Error during LLM invocation: {e}")
-        state["error_message"] = f"LLM analysis of upload dialog failed: {e}"
-        state["analysis_result"] = "Error: LLM analysis of upload dialog failed."
-        
-    return state
-
-async def perform_upload_node(state: AgentState) -> AgentState:
+        logger.error("[Analyze Upload Dialog Node] Error during LLM invocation: %s", e)
+        return Command(update={"error_message": f"LLM analysis of upload dialog failed: {e}",
+                               "analysis_result": "Error: LLM analysis of upload dialog failed.", "upload_target_kind": "none"}, goto=END)
+
+    upload_target_kind = _classify_upload_target(analysis_result)
+    update = {"analysis_result": analysis_result, "error_message": None, "upload_target_kind": upload_target_kind, # Clear previous errors
+              "screenshot": None, "screenshot_hash": None} # Dialog screenshot consumed; perform_upload captures its own
+    logger.info("Decision: analysis result %r classified as %r -> %s", analysis_result, upload_target_kind, _UPLOAD_TARGET_ROUTES[upload_target_kind])
+    # A description (heuristic failed) ends the graph for now; we could add a node here to ASK the user for the selector
+    return Command(update=update, goto=_UPLOAD_TARGET_ROUTES[upload_target_kind])
+
+_UPLOAD_STATUS_ROUTES: dict[UploadStatus, Literal["browse_results", "__end__"]] = {
+    UploadStatus.INITIATED: "browse_results",
+    UploadStatus.FAILED: END,
+}
+
+@audited("perform_upload")
+async def perform_upload_node(state: AgentState) -> Command[Literal["browse_results", "__end__"]]:
     logger.info("--- Executing Node: perform_upload ---")
-    image_path = state.get("image_path")
+    image_path = state.image_path
     # analysis_result here is the locator/text for the "upload file" button/link itself
-    upload_trigger_element_description = state.get("analysis_result", "").strip().strip("'\"")
+    upload_trigger_element_description = (state.analysis_result or "").strip().strip("'\"")
 
     if not image_path:
         logger.error("[Perform Upload Node] Image path not found in state.")
-        state["error_message"] = "Cannot perform upload: Image path missing."
-        return state
+        return Command(update={"error_message": "Cannot perform upload: Image path missing.", "upload_status": UploadStatus.FAILED}, goto=END)
     
     if not upload_trigger_element_description:
         logger.error("[Perform Upload Node] Upload trigger element description not found in state.")
-        state["error_message"] = "Cannot perform upload: Upload trigger element description missing."
-        return state
+        return Command(update={"error_message": "Cannot perform upload: Upload trigger element description missing.", "upload_status": UploadStatus.FAILED}, goto=END)
 
-    logger.info(f"[Perform Upload Node] Cleaned analysis result for upload element: '{upload_trigger_element_description}'")
+    logger.info("[Perform Upload Node] Cleaned analysis result for upload element: %r", upload_trigger_element_description)
     
     upload_result_dict = await _upload_file_internal(
         locator_or_text=upload_trigger_element_description, # This is what LLM found for the upload dialog trigger
         file_path=image_path
     )
+    status_text = upload_result_dict.get("upload_status")
+    # Any error (including a failed capture after a successful file selection) means there is no results page to read
+    upload_status = UploadStatus.FAILED if upload_result_dict.get("error_message") else UploadStatus.INITIATED
+
+    update = {
+        # _upload_file_internal always returns these keys, so the update carries only what it captured
+        "current_url": upload_result_dict["current_url"],
+        "page_content": upload_result_dict["page_content"],
+        "screenshot": upload_result_dict["screenshot"],
+        "screenshot_hash": upload_result_dict.get("screenshot_hash"), # Only the happy path returns one; never reuse the dialog's hash
+        "error_message": upload_result_dict.get("error_message"),
+        # Clear previous analysis_result (which was for upload trigger); analyze_results will populate it.
+        "analysis_result": "",
+        "upload_status": upload_status,
+    }
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[DEBUG perform_upload_node END] Update before return: %s", filter_screenshot_from_state(update))
 
-    state["current_url"] = upload_result_dict.get("current_url", state.get("current_url"))
-    state["page_content"] = upload_result_dict.get("page_content", state.get("page_content"))
-    state["screenshot"] = upload_result_dict.get("screenshot", state.get("screenshot"))
-    state["error_message"] = upload_result_dict.get("error_message")
-    
-    # Clear previous analysis_result (which was for upload trigger)
-    # The next node (analyze_post_upload_page_node) will populate it with submit button analysis.
-    state["analysis_result"] = "" 
-
-    if upload_result_dict.get("error_message"):
-        logger.error(f"[Perform Upload Node] Upload failed: {upload_result_dict.get('error_message')}")
+    if upload_status is UploadStatus.FAILED:
+        logger.error("[Perform Upload Node] Upload failed: %s", update["error_message"])
     else:
-        logger.info(f"[Perform Upload Node] Upload status: {upload_result_dict.get('upload_status')}")
-        logger.info(f"[Perform Upload Node] Page state captured for submit button analysis. URL: {state['current_url']}")
-    
-    logger.debug(f"[DEBUG perform_upload_node END] Final state before return: {filter_screenshot_from_state(state.copy())}")
-    return state
-
-async def browse_results_node(state: AgentState) -> AgentState:
+        logger.info("[Perform Upload Node] Upload status: %s", status_text)
+        logger.info("[Perform Upload Node] Page state captured for results analysis. URL: %s", update["current_url"])
+    goto = _UPLOAD_STATUS_ROUTES[upload_status]
+    logger.info("Decision: upload %s (%r) -> %s", upload_status.name, status_text, goto)
+    return Command(update=update, goto=goto)
+
+@audited("browse_results")
+async def browse_results_node(state: AgentState) -> dict:
     """Node to capture the content of the results page *without* navigating."""
     logger.info("--- Executing Node: browse_results ---")
-    current_url = state.get("current_url")
+    current_url = state.current_url
     if not current_url:
-        state["error_message"] = "Error: current_url not found in state before browsing results."
-        return state
+        return {"error_message": "Error: current_url not found in state before browsing results."}
     
-    logger.info(f"[Browse Results Node] Capturing content from current URL: {current_url}")
+    logger.info("[Browse Results Node] Capturing content from current URL: %s", current_url)
     
     # Now calls the global _capture_current_page
     capture_result = await _capture_current_page()
 
     if capture_result.get("error_message"):
-        state["error_message"] = f"Error browsing results: {capture_result['error_message']}"
-    elif capture_result.get("error"):
-        state["error_message"] = f"Error browsing results: {capture_result['error']}"
-    else:
-        state["page_content"] = capture_result.get("page_content")
-        state["screenshot"] = capture_result.get("screenshot")
-        state["current_url"] = capture_result.get("current_url") # Update URL just in case
-        state["error_message"] = None # Clear previous errors if browse is successful
-        logger.info("[Browse Results Node] Successfully captured results page content and screenshot.")
-        
-    return state
+        return {"error_message": f"Error browsing results: {capture_result['error_message']}"}
+    if capture_result.get("error"):
+        return {"error_message": f"Error browsing results: {capture_result['error']}"}
+    logger.info("[Browse Results Node] Successfully captured results page content and screenshot.")
+    return {
+        "page_content": capture_result.get("page_content"),
+        "screenshot": capture_result.get("screenshot"),
+        "screenshot_hash": capture_result.get("screenshot_hash"),
+        "current_url": capture_result.get("current_url"), # Update URL just in case
+        "error_message": None, # Clear previous errors if browse is successful
+    }
 
-async def analyze_results_node(state: AgentState) -> AgentState:
+@audited("analyze_results")
+async def analyze_results_node(state: AgentState) -> dict:
     """Node to analyze the results page screenshot and text to extract source URLs."""
-    print("--- Executing Node: analyze_results ---")
-    # <<< ADDED DEBUG PRINT >>>
-    print("[DEBUG] Entering analyze_results_node")
-    page_content = state.get("page_content")
-    screenshot_b64 = state.get("screenshot")
-    current_url = state.get("current_url") # For context
+    logger.info("--- Executing Node: analyze_results ---")
+    page_content = state.page_content
+    screenshot_b64 = state.screenshot
+    current_url = state.current_url # For context
 
     if not page_content or not screenshot_b64:
-        state["error_message"] = "Error: Missing page content or screenshot for results analysis."
-        state["analysis_result"] = "Error: Missing input for results analysis."
-        return state
-
-    analysis_prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are an expert visual analysis assistant. Your task is to analyze the provided screenshot and text from a Google Lens search results page. "
-                   "Focus on the section titled '包含匹配图片的页面' (Pages that include matching images). "
-                   "Extract all the source URLs listed under that section. "
-                   "Format your response clearly, starting with 'Visually similar images found.', then mentioning the section title found, and finally listing the extracted URLs under 'Found URLs:'."),
-        ("human", [
-            {"type": "text", "text": f"""Relevant text from the results page (URL: {current_url}):
-```
-{page_content[:1000]}...```
+        return {"error_message": "Error: Missing page content or screenshot for results analysis.",
+                "analysis_result": "Error: Missing input for results analysis."}
 
-Screenshot of the results page:"""},
-            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{screenshot_b64}"}},
-            {"type": "text", "text": "\n\nPlease analyze the screenshot and text, specifically find the section '包含匹配图片的页面' and list all the source URLs shown under it."}
-        ])
-    ])
-    
-    print("[Analyze Results Node] Invoking LLM for results analysis...")
-    llm = ChatOpenAI(model="gpt-4o", temperature=0, max_tokens=1000)
-    chain = analysis_prompt | llm | StrOutputParser()
-    
+    logger.debug("[Analyze Results Node] Invoking LLM for results analysis...")
     try:
-        analysis_result = await chain.ainvoke({})
-        state["analysis_result"] = analysis_result
-        state["error_message"] = None
-        print(f"[Analyze Results Node] LLM Analysis Result:\n{analysis_result}")
+        analysis_result = await RESULTS_CHAIN.ainvoke({
+            "current_url": current_url,
+            "page_text": trim_to_tokens(page_content, PROMPT_TEXT_SNIPPET_TOKENS),
+            "screenshot_b64": screenshot_b64,
+        })
     except Exception as e:
-        print(f"[Analyze Results Node] Error during LLM invocation: {e}")
-        state["error_message"] = f"LLM analysis failed: {e}"
-        state["analysis_result"] = "Error: LLM analysis failed."
-        
-    return state
-
-# --- LangGraph Conditional Edges --- 
-
-def should_click_or_end(state: AgentState) -> str:
-    """Determines the next step after visual analysis."""
-    print("--- Evaluating Edge: should_click_or_end ---")
-    analysis_result = state.get("analysis_result")
-    error = state.get("error_message")
-    if error:
-        print(f"Decision: Error detected -> End ({error})")
-        return "end_error"
-    if analysis_result == "Camera icon not visually found":
-        print("Decision: Icon not found -> End")
-        return "end_not_found"
-    elif analysis_result: # Assumes any other non-empty result is a description/selector to click
-        print("Decision: Description/Selector for camera icon found -> Click")
-        return "click"
-    else:
-        print("Decision: Camera analysis failed -> End Error")
-        state["error_message"] = "Camera analysis result was empty or missing."
-        return "end_error"
-
-def should_browse_for_upload_or_end(state: AgentState) -> str:
-    """Determines the next step after attempting a click (to open upload dialog)."""
-    print("--- Evaluating Edge: should_browse_for_upload_or_end ---")
-    error = state.get("error_message")
-    if error:
-        print(f"Decision: Click (to open dialog) failed -> End ({error})")
-        return "end_error"
-    else:
-        print("Decision: Click (to open dialog) successful -> Capture Upload Dialog Page")
-        return "capture_upload_dialog_page" # New transition name
-
-def should_perform_upload_or_end(state: AgentState) -> str:
-    """Conditional edge deciding whether to upload or end."""
-    print("--- Evaluating Edge: should_perform_upload_or_end ---")
-    analysis_result = state.get("analysis_result")
-    error_message = state.get("error_message") # Check for errors from previous node too
-
-    if error_message and "Error:" in error_message:
-         print(f"Decision: Error found ('{error_message}'). Ending graph.")
-         return "__end__"
-         
-    if not analysis_result or "not found" in analysis_result.lower() or "error" in analysis_result.lower():
-        print(f"Decision: No valid analysis result ('{analysis_result}'). Ending graph.")
-        return "__end__"
-
-    # <<< MODIFIED: Heuristic to accept short text as potential locators >>>
-    cleaned_result = analysis_result.strip()
-    if cleaned_result.startswith("`") and cleaned_result.endswith("`"):
-        cleaned_result = cleaned_result[1:-1].strip()
-        
-    # Consider it a likely locator if it's not clearly a long description
-    # Heuristic: Fewer than 4 words AND does not contain 'icon' (which was our previous failure mode)
-    word_count = len(cleaned_result.split())
-    is_likely_locator = bool(cleaned_result) and word_count < 4 and "icon" not in cleaned_result.lower()
+        logger.error("[Analyze Results Node] Error during LLM invocation: %s", e)
+        return {"error_message": f"LLM analysis failed: {e}", "analysis_result": "Error: LLM analysis failed."}
 
-    if is_likely_locator:
-        print(f"Decision: Analysis result ('{analysis_result}') looks like a locator/text (heuristic: <4 words, no 'icon'). Proceeding to upload.")
-        return "perform_upload"
-    else:
-        # If it doesn't look like a selector/short text, assume it's a description or error
-        print(f"Decision: Analysis result ('{analysis_result}') does not look like a locator/text (heuristic failed). Ending graph.")
-        # We could potentially add a node here to ASK the user for the selector if we get a description
-        return "__end__" # End for now if it's descriptive
-
-def should_browse_results_or_end(state: AgentState) -> str:
-    """Determines whether to browse results page or end after upload attempt."""
-    print("--- Evaluating Edge: should_browse_results_or_end ---")
-    # <<< ADDED DEBUG PRINT >>>
-    print(f"[DEBUG Edge should_browse_results_or_end START] Incoming state: {state}")
-    print(f"[DEBUG Edge] Current error_message in state: {state.get('error_message')!r}")
-    print(f"[DEBUG Edge] Current upload_result in state: {state.get('upload_result')!r}")
-    # <<< END ADDED DEBUG PRINTS >>>
-    upload_result = state.get("upload_result") # Check upload_result now
-    error = state.get("error_message")
-
-    # Prioritize explicit errors from the state
-    if error and "Error:" in error:
-        print(f"Decision: Error state detected -> End ({error})")
-        return "end_error"
-        
-    # Check if upload_result indicates success
-    if upload_result and "successfully" in upload_result.lower():
-        print(f"Decision: Upload successful ('{upload_result}') -> Browse Results")
-        return "browse_results" # Go to the new node
-    else:
-        print(f"Decision: Upload failed or status unclear ('{upload_result}') -> End Error")
-        # Ensure error message reflects this if not already set
-        if not error:
-             state["error_message"] = f"Upload failed or status unclear: {upload_result}"
-        return "end_error"
-
-def should_return_results_or_end(state: AgentState) -> str:
-    """Determines whether to end successfully with results or end with an error after analysis."""
-    print("--- Evaluating Edge: should_return_results_or_end ---")
-    analysis_result = state.get("analysis_result")
-    error = state.get("error_message")
-
-    if error and "Error:" in error: # Check for errors during analysis first
-        print(f"Decision: Error during results analysis -> End ({error})")
-        return "end_error"
-        
-    if analysis_result and "Found URLs:" in analysis_result:
-        print(f"Decision: Found URLs in analysis result -> End Success")
-        return "end_success"
-    else:
-        print(f"Decision: Analysis result does not contain URLs or is missing ('{analysis_result}') -> End Error")
-        state["error_message"] = f"Failed to extract URLs from results page. Analysis: {analysis_result}"
-        return "end_error"
+    logger.info("[Analyze Results Node] LLM Analysis Result:\n%s", analysis_result)
+    error_message = None
+    if "Found URLs:" not in analysis_result:
+        logger.warning("[Analyze Results Node] Analysis result does not contain URLs.")
+        error_message = f"Failed to extract URLs from results page. Analysis: {analysis_result}"
+    return {"analysis_result": analysis_result, "error_message": error_message}
 
 # --- Build the Graph --- 
 
-workflow = StateGraph(AgentState)
-
-# Define the nodes
-workflow.add_node("start_browse", start_browse_node)
-workflow.add_node("analyze_vision", analyze_vision_node) 
-workflow.add_node("click", click_node) 
-workflow.add_node("capture_upload_dialog_page", upload_browse_node)
-workflow.add_node("analyze_upload_dialog", analyze_upload_dialog_node)
-workflow.add_node("perform_upload", perform_upload_node)
-workflow.add_node("browse_results", browse_results_node)
-workflow.add_node("analyze_results", analyze_results_node)
-
-# Define the edges
-workflow.set_entry_point("start_browse")
-workflow.add_edge("start_browse", "analyze_vision")
-
-# Conditional edge after camera icon analysis
-workflow.add_conditional_edges(
-    "analyze_vision",
-    should_click_or_end,
-    {
-        "click": "click",
-        "end_not_found": END, 
-        "end_error": END     
-    }
-)
-
-# Conditional edge after click attempt (to open dialog)
-workflow.add_conditional_edges(
-    "click",
-    should_browse_for_upload_or_end,
-    {
-        "capture_upload_dialog_page": "capture_upload_dialog_page", 
-        "end_error": END 
-    }
-)
-
-# Edge from capturing upload dialog page to analyzing it
-workflow.add_edge("capture_upload_dialog_page", "analyze_upload_dialog")
-
-# Conditional edge after analyzing upload dialog
-workflow.add_conditional_edges(
-    "analyze_upload_dialog",
-    should_perform_upload_or_end,
-    {
-        "perform_upload": "perform_upload",
-        "end_not_found": END,
-        "end_error": END
-    }
-)
-
-# Conditional edge after perform_upload node
-workflow.add_conditional_edges(
-    "perform_upload",
-    should_browse_results_or_end, # Use corrected function
-    {
-        "browse_results": "browse_results", # Go to browse_results on success
-        "end_error": END
-    }
-)
-
-# <<< ADDED Edge from browsing results to analyzing results >>>
-workflow.add_edge("browse_results", "analyze_results")
-
-# <<< ADDED Conditional edge after analyzing results >>>
-workflow.add_conditional_edges(
-    "analyze_results",
-    should_return_results_or_end,
-    {
-        "end_success": END, # End successfully if URLs are found
-        "end_error": END  # End with error if URLs are not found
-    }
-)
-
-# Compile the graph
-app = workflow.compile()
+def build_workflow() -> StateGraph:
+    """Declares the agent's nodes and static edges (the routing nodes add the rest via Command(goto=...))."""
+    workflow = StateGraph(AgentState)
+
+    # Define the nodes
+    workflow.add_node("start_browse", start_browse_node)
+    workflow.add_node("fast_click", fast_click_node)
+    workflow.add_node("analyze_vision", analyze_vision_node) 
+    workflow.add_node("click", click_node) 
+    workflow.add_node("capture_upload_dialog_page", upload_browse_node)
+    workflow.add_node("analyze_upload_dialog", analyze_upload_dialog_node)
+    workflow.add_node("perform_upload", perform_upload_node)
+    workflow.add_node("browse_results", browse_results_node)
+    workflow.add_node("analyze_results", analyze_results_node)
+
+    # Define the edges
+    workflow.set_entry_point("start_browse")
+    workflow.add_edge("start_browse", "fast_click")
+    # fast_click, analyze_vision, click, analyze_upload_dialog and perform_upload route themselves by returning Command(goto=...)
+    workflow.add_edge("capture_upload_dialog_page", "analyze_upload_dialog")
+    workflow.add_edge("browse_results", "analyze_results")
+    workflow.add_edge("analyze_results", END)
+    return workflow
+
+@functools.lru_cache(maxsize=1)
+def get_app():
+    """Compiles the graph on first use and returns the same compiled app afterwards, so importing this module
+    (e.g. from a test harness or a web worker) never pays for compile()'s validation pass more than once."""
+    return build_workflow().compile()
+
+# Only the graph itself, its nodes and tools are logged by run_graph; filtering by name/type inside astream_events
+# keeps LangChain from dispatching the internal prompt/LLM/parser/edge-router runs to Python at all.
+_STREAMED_EVENT_TYPES = ["tool"]
+MAX_STREAMED_EVENTS = 10_000 # A normal run emits a few dozen filtered events
+
+@functools.lru_cache(maxsize=1)
+def _streamed_event_names() -> list[str]:
+    app = get_app()
+    return [app.get_name(), *app.builder.nodes]
+
+# --- Event Logging Helpers ---
+_MAX_TOOL_REPR = 80 # Characters of a tool input/output echoed per event
+_SKIP_KEYS = {"screenshot", "screenshot_base64", "image_bytes"} # Large payloads summarised by size instead of printed
+
+def _truncate_repr(value, limit: int = _MAX_TOOL_REPR) -> str:
+    """Short one-line repr of a tool input/output for event logs. Slices strings before formatting them and never
+    stringifies screenshot payloads, so the cost does not grow with the size of the captured page."""
+    if value is None:
+        return "None"
+    if isinstance(value, (str, bytes)):
+        head = value[:limit]
+        return (head if isinstance(head, str) else repr(head)) + ("..." if len(value) > limit else "")
+    if isinstance(value, dict):
+        parts = []
+        for key, item in value.items():
+            if key in _SKIP_KEYS and isinstance(item, (str, bytes)):
+                parts.append(f"{key}=<{len(item)}B>")
+            else:
+                parts.append(f"{key}={_truncate_repr(item, limit)}")
+        return "{" + ", ".join(parts) + "}"
+    if isinstance(value, (list, tuple)): # e.g. the graph's own end-of-run output, a list of node updates
+        return "[" + ", ".join(_truncate_repr(item, limit) for item in value) + "]"
+    return _truncate_repr(repr(value), limit)
+
+_SHOT_KEYS = ("screenshot", "screenshot_base64") # Where the capture tools put their base64 screenshot
+
+def _summarize_tool_output(output) -> str:
+    """One-line summary of a browse/capture tool result for the tool-end log: text length and whether a screenshot came back."""
+    if not isinstance(output, dict):
+        return _truncate_repr(output)
+    summary = f"text_len={len(output.get('text_content') or '')}"
+    for key in _SHOT_KEYS:
+        value = output.get(key)
+        if isinstance(value, str) and len(value) > 200:
+            summary += f", {key}:[omitted]"
+            break
+    else:
+        summary += ", screenshot:No/Empty"
+    error = output.get("error") or output.get("error_message")
+    return summary + (f", error={_truncate_repr(error)}" if error else "")
 
 # --- Main Execution (Using LangGraph) ---
 async def run_graph(task: str, image_path: str):
@@ -1014,110 +1276,110 @@ async def run_graph(task: str, image_path: str):
     initial_state = AgentState(task=task, image_path=image_path)
     
     final_state = None # Initialize final_state
+    app = get_app()
     try:
-        # Stream events to see the flow
-        async for event in app.astream_events(initial_state, config=config, version="v1"):
-            kind = event["event"]
-            node_name = event['name'] # Get name regardless of event type
+        # Each run gets its own pooled page; get_page() resolves to it inside the graph nodes
+        async with page_pool.acquire():
+            # Stream events to see the flow
+            event_stream = app.astream_events(initial_state, config=config, version="v1",
+                                              include_names=_streamed_event_names(), include_types=_STREAMED_EVENT_TYPES)
+            event_count = 0
+            async for event in event_stream:
+                event_count += 1
+                if event_count > MAX_STREAMED_EVENTS:
+                    # astream_events has no bound of its own; a runaway run (e.g. a routing loop) would otherwise grow forever
+                    logger.error("Graph emitted more than %d events; aborting the run.", MAX_STREAMED_EVENTS)
+                    await event_stream.aclose() # Cancels the underlying graph run instead of leaving it going
+                    break
+                kind = event["event"]
+                node_name = event['name'] # Get name regardless of event type
+                tracing = logger.isEnabledFor(logging.DEBUG) # Step traces are only formatted when DEBUG is on
             
-            if kind == "on_chain_start":
-                print(f"\nStarting step: {node_name}")
-            elif kind == "on_chain_end":
-                # <<< MODIFIED: Check and replace screenshot in output before printing >>>
-                output_data = event['data'].get('output')
-                log_output = "Unknown/NotDict" # Default log value
-                if isinstance(output_data, dict):
-                    # Create a copy to modify for logging
-                    log_output = output_data.copy()
-                    if "screenshot" in log_output and isinstance(log_output.get("screenshot"), str) and len(log_output.get("screenshot", "")) > 200:
-                        log_output["screenshot"] = "[... base64 screenshot omitted by logger ...]"
-                    # Also check for the other key used in browse internal tool
-                    if "screenshot_base64" in log_output and isinstance(log_output.get("screenshot_base64"), str) and len(log_output.get("screenshot_base64", "")) > 200:
-                         log_output["screenshot_base64"] = "[... base64 screenshot_base64 omitted by logger ...]"
-                elif output_data is not None:
-                     log_output = str(output_data) # Handle non-dict outputs
-                
-                print(f"Finished step: {node_name} [Output: {log_output}]") 
-                # <<< END MODIFIED SECTION >>>
-            elif kind == "on_tool_start":
-                 # Ensure input is truncated if potentially large
-                 tool_input = str(event['data'].get('input'))
-                 print(f"  Tool Start: {node_name} [Input: {tool_input[:100]}{'...' if len(tool_input) > 100 else ''}]") 
-            elif kind == "on_tool_end":
-                 # <<< STRICT OMISSION: Always summarize or truncate tool output >>>
-                 tool_output = event['data'].get('output')
-                 output_summary = ""
-                 if isinstance(tool_output, dict):
-                      # Check both potential keys for screenshot data
-                      text_content_len = len(tool_output.get('text_content', ''))
-                      ss_omitted = False
-                      if tool_output.get('screenshot') and isinstance(tool_output.get('screenshot'), str) and len(tool_output.get('screenshot', '')) > 200:
-                           output_summary = f"text_len={text_content_len}, screenshot: [omitted in tool_end summary]"
-                           ss_omitted = True
-                      elif tool_output.get('screenshot_base64') and isinstance(tool_output.get('screenshot_base64'), str) and len(tool_output.get('screenshot_base64', '')) > 200:
-                           output_summary = f"text_len={text_content_len}, screenshot_base64: [omitted in tool_end summary]"
-                           ss_omitted = True
-                      # Handle cases where screenshot might already be omitted string or None/empty
-                      if not ss_omitted:
-                          ss_val = tool_output.get('screenshot', tool_output.get('screenshot_base64'))
-                          if isinstance(ss_val, str) and ss_val.startswith("[... base64"):
-                               output_summary = f"text_len={text_content_len}, screenshot: [already omitted]"
-                          else:
-                               output_summary = f"text_len={text_content_len}, screenshot: No/Empty"
-                 elif tool_output is not None:
-                      # Generic truncation for other outputs
-                      output_str = str(tool_output)
-                      output_summary = f"{output_str[:80]}{'...' if len(output_str) > 80 else ''}"
-                 else:
-                      output_summary = "None"
-                 print(f"  Tool End: {node_name} [Output Summary: {output_summary}]")
-                 
-            # Keep track of the latest state snapshot if needed for final output
-            # (Alternative: call get_state after the loop)
-            if event["event"] == "on_chain_end": 
-                 current_output = event['data'].get('output')
-                 if isinstance(current_output, dict): # Nodes usually return the state
-                     final_state = current_output # Store the latest state output
-
-        # <<< ADDED: Print final result after the loop >>>
-        print("\n--- Graph Execution Complete --- ")
-        # Try getting the final state explicitly
-        try:
-            final_state_explicit = await app.aget_state(config)
-            # The state object might have a 'values' attribute or be the dict directly
-            final_state_values = getattr(final_state_explicit, 'values', final_state_explicit)
-            if isinstance(final_state_values, dict):
-                final_result = final_state_values.get('analysis_result')
-                error_msg = final_state_values.get('error_message')
-                print("\n>>> Final Analysis Result:")
-                print(final_result if final_result else "No analysis result found in final state.")
-                if error_msg:
-                    print(f"Final Error Message: {error_msg}")
-            else:
-                 print("Could not extract final state values as dictionary.")
-        except Exception as e_get_state:
-            print(f"Error getting final state explicitly: {e_get_state}")
-            # Fallback to the last state captured during streaming if explicit get fails
-            if final_state and isinstance(final_state, dict):
-                 print("\n>>> Final Analysis Result (from last streamed state):")
-                 final_result_streamed = final_state.get('analysis_result')
-                 error_msg_streamed = final_state.get('error_message')
-                 print(final_result_streamed if final_result_streamed else "No analysis result found in last streamed state.")
-                 if error_msg_streamed:
-                    print(f"Final Error Message (from last streamed state): {error_msg_streamed}")
-            else:
-                 print("Could not retrieve final analysis result.")
-        # <<< END ADDED SECTION >>>
+                if kind == "on_chain_start":
+                    if tracing:
+                        logger.debug("Starting step: %s", node_name)
+                elif kind == "on_chain_end":
+                    output_data = event['data'].get('output')
+                    if isinstance(output_data, Command): # Routing nodes return Command(update=..., goto=...)
+                        output_data = output_data.update or {}
+                    if tracing:
+                        # _truncate_repr summarises screenshots by size and clips long values, without copying the state
+                        logger.debug("Finished step: %s [Output: %s]", node_name, _truncate_repr(output_data))
+                    # Keep track of the latest state snapshot if needed for final output
+                    # (Alternative: call get_state after the loop)
+                    if isinstance(output_data, dict) and node_name != app.get_name(): # Nodes return (partial) state updates; skip the graph's own summary
+                        # Fold them into the latest state snapshot, appending audit entries like the graph's reducer
+                        previous_trace = (final_state or {}).get("audit_trace", [])
+                        final_state = {**(final_state or {}), **output_data}
+                        final_state["audit_trace"] = previous_trace + output_data.get("audit_trace", [])
+                elif kind == "on_tool_start":
+                     print(f"  Tool Start: {node_name} [Input: {_truncate_repr(event['data'].get('input'), 100)}]")
+                elif kind == "on_tool_end":
+                     print(f"  Tool End: {node_name} [Output Summary: {_summarize_tool_output(event['data'].get('output'))}]")
+
+            # <<< ADDED: Print final result after the loop >>>
+            print("\n--- Graph Execution Complete --- ")
+            # Try getting the final state explicitly
+            try:
+                final_state_explicit = await app.aget_state(config)
+                # The state object might have a 'values' attribute or be the dict directly
+                final_state_values = getattr(final_state_explicit, 'values', final_state_explicit)
+                if isinstance(final_state_values, dict):
+                    final_result = final_state_values.get('analysis_result')
+                    error_msg = final_state_values.get('error_message')
+                    print("\n>>> Final Analysis Result:")
+                    print(final_result if final_result else "No analysis result found in final state.")
+                    if error_msg:
+                        print(f"Final Error Message: {error_msg}")
+                else:
+                     print("Could not extract final state values as dictionary.")
+            except Exception as e_get_state:
+                print(f"Error getting final state explicitly: {e_get_state}")
+                # Fallback to the last state captured during streaming if explicit get fails
+                if final_state and isinstance(final_state, dict):
+                     print("\n>>> Final Analysis Result (from last streamed state):")
+                     final_result_streamed = final_state.get('analysis_result')
+                     error_msg_streamed = final_state.get('error_message')
+                     print(final_result_streamed if final_result_streamed else "No analysis result found in last streamed state.")
+                     if error_msg_streamed:
+                        print(f"Final Error Message (from last streamed state): {error_msg_streamed}")
+                     print("Audit trace: " + " | ".join(final_state.get("audit_trace", [])))
+                else:
+                     print("Could not retrieve final analysis result.")
+            # <<< END ADDED SECTION >>>
 
     except Exception as e:
-        print(f"\n--- Graph Invocation Error ---")
-        print(f"{type(e).__name__}: {e}")
-        print(traceback.format_exc())
+        # Full traceback only at DEBUG; exc_info defers formatting it to the handlers that actually emit the record
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.error("--- Graph Invocation Error ---", exc_info=True)
+        else:
+            logger.error("--- Graph Invocation Error --- %s: %s", type(e).__name__, e)
+        if trace_buffer.records:
+            try:
+                with open(TRACE_DUMP_PATH, "w", encoding="utf-8") as f:
+                    f.write(trace_buffer.dump())
+                logger.error("Recent agent trace written to %s", TRACE_DUMP_PATH)
+            except OSError as dump_e:
+                logger.warning("Could not write agent trace: %s", dump_e)
+    finally:
+        print("\n--- Graph Finished (Page Released) ---")
+
+async def run_graph_and_shutdown(task: str, image_path: str):
+    """One-shot entry point: runs the graph once, then tears down the shared browser."""
+    try:
+        await warmup()
+        await run_graph(task=task, image_path=image_path)
     finally:
-        await close_page_and_browser()
-        print("\n--- Graph Finished (Browser Closed) ---")
+        await shutdown_browser()
+        print("\n--- Browser Closed ---")
 
 if __name__ == "__main__":
+    print("[DEBUG] agent_main.py script started")
+    # Route the module's logger output (node progress, warnings, errors) to stderr; LOG_LEVEL=DEBUG adds tracebacks
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    trace_buffer.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(trace_buffer) # Keep the recent trail for the postmortem dump in run_graph
+
     openai_key = os.getenv("OPENAI_API_KEY")
     if not openai_key:
         print("Warning: OPENAI_API_KEY not found in environment variables. Make sure .env file is set up correctly.")
@@ -1127,23 +1389,21 @@ if __name__ == "__main__":
 
     # Define the task and the image path for the agent
     # *** IMPORTANT: Replace with the ACTUAL path to your test image ***
-    # Assumes the script is run from 'findsourceurl-agent' directory
-    # and 'data' directory is at the same level as 'findsourceurl-agent'
-    relative_image_path = "../data/github.png" 
-    test_image_path = os.path.abspath(relative_image_path) 
-    
-    print(f"Attempting to use image path: {test_image_path}")
-    
-    if not os.path.exists(test_image_path):
-        print(f"Error: Test image not found at resolved path: {test_image_path}")
-        print(f"(Looked for relative path: {relative_image_path})")
-        print("Please update the 'relative_image_path' variable in agent_main.py or ensure the file exists.")
-        exit()
-        
+    # Resolved against this file's directory, so the script works from any CWD
+    image_path_candidate = Path(__file__).parent / "data" / "github.png"
+    try:
+        test_image_path = str(image_path_candidate.resolve(strict=True))
+    except FileNotFoundError as e:
+        print(f"Error: Test image not found: {e}")
+        print("Please update 'image_path_candidate' in agent_main.py or ensure the file exists.")
+        exit(1)
+
+    print(f"Using image path: {test_image_path}")
+
     agent_task = f"Find the source URLs for the image located at {test_image_path}"
 
     # Run the graph execution
-    asyncio.run(run_graph(task=agent_task, image_path=test_image_path))
+    asyncio.run(run_graph_and_shutdown(task=agent_task, image_path=test_image_path))
 
 # --- Keep old test function for reference if needed ---
 async def test_playwright():
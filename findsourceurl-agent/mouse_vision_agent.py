@@ -1,10 +1,19 @@
 import pyautogui
 import openai
+import httpx
+import cv2
+import mss
+import numpy as np
 import base64
+import ctypes
+import hashlib
+import io
 import os
+import sys
 import time
 import re # 导入正则表达式模块
 import webbrowser # 导入webbrowser模块
+from pathlib import Path
 import pyperclip # 导入 pyperclip
 from dotenv import load_dotenv
 
@@ -17,7 +26,15 @@ if not OPENAI_API_KEY:
     print("错误：请确保 .env 文件中已设置 OPENAI_API_KEY")
     exit()
 
-client = openai.OpenAI(api_key=OPENAI_API_KEY)
+# 全局复用一个 HTTP/2 连接池，多次调用 GPT-4o 时免去重复的 TCP/TLS 握手
+client = openai.OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        limits=httpx.Limits(max_keepalive_connections=10),
+    ),
+)
 
 # 全局变量，用于模板图片名称
 CAMERA_ICON_TEMPLATE_PATH = "camera_icon_template.png"
@@ -25,6 +42,121 @@ UPLOAD_BUTTON_TEMPLATE_PATH = "upload_button_template.png" # 新增上传按钮
 DIALOG_OPEN_BUTTON_TEMPLATE_PATH = "open_button_template.png" # 新增打开按钮模板
 # 将使用 data 目录下的 github.png
 YOUR_IMAGE_TO_UPLOAD_PATH = os.path.join("data", "1.png") 
+# 设置 DEBUG_SCREENSHOTS=1 时才把实时截图写入磁盘 (调试用)，正常运行直接在内存中编码
+DEBUG_SCREENSHOTS = os.getenv("DEBUG_SCREENSHOTS", "0") == "1"
+# 截取模板图片时显示器的缩放比例 (例如在 150% 缩放的 Windows 上截取则设为 1.5)。
+# 未设置时认为模板就是在本机按物理像素截取的，不做缩放；只有模板来自缩放比例不同的另一台显示器时才需要设置
+TEMPLATE_CAPTURE_SCALE = os.getenv("TEMPLATE_CAPTURE_SCALE")
+
+def _display_scale():
+    """
+    返回当前主显示器每个逻辑坐标对应的截图像素数。
+    Windows 上读取系统 DPI；macOS/Linux 上比较 mss 截图像素与逻辑区域的大小 (Retina 屏为 2)。
+    """
+    if sys.platform == "win32":
+        try:
+            return ctypes.windll.user32.GetDpiForSystem() / 96
+        except (AttributeError, OSError):
+            return 1.0
+    with mss.mss() as sct:
+        monitor = sct.monitors[1]
+        probe = {"left": monitor["left"], "top": monitor["top"], "width": 100, "height": 100}
+        return sct.grab(probe).width / probe["width"]
+
+def _load_template(path, scale):
+    """读取灰度模板，并按当前显示缩放比例一次性缩放，匹配时只需单一尺度。"""
+    template = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if template is None or abs(scale - 1.0) < 0.01:
+        return template
+    interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_CUBIC
+    return cv2.resize(template, None, fx=scale, fy=scale, interpolation=interpolation)
+
+# 启动时一次性读取、转为灰度并按 DPI 缩放的模板图片 (模板路径 -> np.ndarray)，磁盘上不存在的模板直接跳过
+_TEMPLATE_SCALE = _display_scale() / float(TEMPLATE_CAPTURE_SCALE) if TEMPLATE_CAPTURE_SCALE else 1.0
+_TEMPLATES = {
+    path: _load_template(path, _TEMPLATE_SCALE)
+    for path in (CAMERA_ICON_TEMPLATE_PATH, UPLOAD_BUTTON_TEMPLATE_PATH, DIALOG_OPEN_BUTTON_TEMPLATE_PATH)
+    if os.path.exists(path)
+}
+# 模板上次命中的区域 (模板路径 -> mss 区域)，下次优先只在该区域附近匹配
+_LAST_MATCH_ROI = {}
+ROI_MARGIN = 150 # 缓存区域在命中位置四周额外保留的像素
+# GPT-4o 响应的磁盘缓存目录 (按截图+提示词的哈希存放)，开发时重复分析同一截图可直接命中
+GPT_CACHE_DIR = Path(".gpt_cache")
+# 坐标正则只编译一次：查找括号中的两个数字，用逗号分隔，允许空格 (流式响应中会被反复调用)
+_COORD_RE = re.compile(r"\(\s*(\d+)\s*,\s*(\d+)\s*\)")
+
+def _match_in_region(sct, region, template, confidence):
+    """
+    在指定屏幕区域内做灰度模板匹配。
+    命中时返回 (中心坐标, 命中框)，坐标为 pyautogui 使用的逻辑坐标；否则返回 None。
+    """
+    shot = sct.grab(region)
+    # mss 返回 BGRA 帧缓冲，直接转为单通道灰度再匹配
+    gray = cv2.cvtColor(np.asarray(shot), cv2.COLOR_BGRA2GRAY)
+    th, tw = template.shape
+    if gray.shape[0] < th or gray.shape[1] < tw:
+        return None
+    result = cv2.matchTemplate(gray, template, cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, max_loc = cv2.minMaxLoc(result)
+    if max_val < confidence:
+        return None
+    # 高 DPI 屏幕上截图像素与逻辑坐标不一致，按比例换算回逻辑坐标
+    scale = shot.width / region["width"]
+    left = region["left"] + max_loc[0] / scale
+    top = region["top"] + max_loc[1] / scale
+    width, height = tw / scale, th / scale
+    center = (int(left + width / 2), int(top + height / 2))
+    return center, (left, top, width, height)
+
+def locate_center_on_screen(template_path, confidence=0.8):
+    """
+    使用 mss 截屏 + OpenCV 灰度 matchTemplate 在主屏幕上查找已预加载的模板，替代 pyautogui.locateCenterOnScreen。
+    若该模板之前命中过，先只在上次命中位置附近的区域匹配，未命中再回退到全屏。
+
+    Args:
+        template_path (str): 模板图片路径。
+        confidence (float): TM_CCOEFF_NORMED 匹配阈值。
+    Returns:
+        tuple: (x, y) 中心坐标，如果找到的话；否则返回 None。
+    """
+    template = _TEMPLATES.get(template_path)
+    if template is None:
+        print(f"错误：模板图片 '{template_path}' 未加载")
+        return None
+    with mss.mss() as sct:
+        monitor = sct.monitors[1] # 主显示器，与 pyautogui 的坐标系一致
+        regions = [monitor]
+        if template_path in _LAST_MATCH_ROI:
+            regions.insert(0, _LAST_MATCH_ROI[template_path])
+        for region in regions:
+            match = _match_in_region(sct, region, template, confidence)
+            if match:
+                center, (left, top, width, height) = match
+                roi_left = max(monitor["left"], int(left) - ROI_MARGIN)
+                roi_top = max(monitor["top"], int(top) - ROI_MARGIN)
+                roi_right = min(monitor["left"] + monitor["width"], int(left + width) + ROI_MARGIN)
+                roi_bottom = min(monitor["top"] + monitor["height"], int(top + height) + ROI_MARGIN)
+                _LAST_MATCH_ROI[template_path] = {
+                    "left": roi_left, "top": roi_top,
+                    "width": roi_right - roi_left, "height": roi_bottom - roi_top,
+                }
+                return center
+    return None
+
+def wait_for(template_path, timeout=15, interval=0.2, confidence=0.8):
+    """
+    每隔 interval 秒在屏幕上查找一次模板，出现即返回其中心坐标，取代固定时长的 time.sleep 等待。
+    超过 timeout 秒仍未出现则返回 None。
+    """
+    if template_path not in _TEMPLATES:
+        return locate_center_on_screen(template_path, confidence=confidence) # 模板未加载，不必轮询
+    deadline = time.monotonic() + timeout
+    while True:
+        coords = locate_center_on_screen(template_path, confidence=confidence)
+        if coords or time.monotonic() >= deadline:
+            return coords
+        time.sleep(interval)
 
 def capture_and_encode_screenshot(filename="screenshot.png", use_manual_file=None, for_ai_analysis=True):
     """
@@ -48,28 +180,30 @@ def capture_and_encode_screenshot(filename="screenshot.png", use_manual_file=Non
             # print("准备实时截图，请确保目标窗口在前台且内容已加载。等待0.5秒...") # 可以更短或省略，因为后续有等待
             time.sleep(0.2) # 略微等待
             screenshot = pyautogui.screenshot()
-            # 将实时截图始终保存，以便调试或后续模板匹配 (如果需要基于特定截图)
             saved_filename = f"realtime__{filename}"
-            screenshot.save(saved_filename)
-            print(f"实时截图已保存为 {saved_filename}")
+            # 只生成文件名时必须落盘；否则仅在调试模式下保存，以便调试或后续模板匹配 (如果需要基于特定截图)
+            if DEBUG_SCREENSHOTS or not for_ai_analysis:
+                screenshot.save(saved_filename)
+                print(f"实时截图已保存为 {saved_filename}")
             if for_ai_analysis:
-                with open(saved_filename, "rb") as image_file:
-                    encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                # os.remove(saved_filename) # 调试时可保留
-                return encoded_string
+                # 直接在内存中编码为 PNG 再转 Base64，省去写盘后再读回的往返；compress_level=1 大幅减少 zlib 压缩时间
+                with io.BytesIO() as buffer:
+                    screenshot.save(buffer, format="PNG", compress_level=1)
+                    return base64.b64encode(buffer.getbuffer()).decode('ascii')
             else:
                 return saved_filename # 返回保存的文件名
     except Exception as e:
         print(f"处理图像时出错: {e}")
         return None
 
-def analyze_image_with_gpt4o(base64_image, prompt_text):
+def analyze_image_with_gpt4o(base64_image, prompt_text, stop_at_coordinates=False):
     """
     使用 GPT-4o Vision API 分析图像。
 
     Args:
         base64_image (str): Base64 编码的图像字符串。
         prompt_text (str): 给模型的提示文本。
+        stop_at_coordinates (bool): 为 True 时以流式方式接收响应，一旦文本中出现 (x, y) 坐标就提前返回已收到的部分。
 
     Returns:
         str: 模型的文本响应。
@@ -77,44 +211,63 @@ def analyze_image_with_gpt4o(base64_image, prompt_text):
     if not base64_image:
         return "无法分析图像，因为截图未成功生成。"
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
-
-    payload = {
-        "model": "gpt-4o",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt_text
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/png;base64,{base64_image}"
-                        }
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": prompt_text
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/png;base64,{base64_image}"
                     }
-                ]
-            }
-        ],
-        "max_tokens": 350 # 稍微增加token，以便获取更详细描述和坐标
-    }
+                }
+            ]
+        }
+    ]
 
     try:
         response = client.chat.completions.create(
-            model=payload["model"],
-            messages=payload["messages"],
-            max_tokens=payload["max_tokens"]
+            model="gpt-4o",
+            messages=messages,
+            max_tokens=350, # 稍微增加token，以便获取更详细描述和坐标
+            stream=stop_at_coordinates
         )
+        if stop_at_coordinates:
+            text = ""
+            with response:
+                for chunk in response:
+                    if chunk.choices:
+                        text += chunk.choices[0].delta.content or ""
+                    if extract_coordinates(text):
+                        break # 已拿到坐标，退出时关闭流，不再等待剩余生成
+            return text
         return response.choices[0].message.content
     except Exception as e:
         print(f"调用 OpenAI API 时出错: {e}")
         return f"调用 OpenAI API 时出错: {e}"
 
+def analyze_image_with_gpt4o_cached(base64_image, prompt_text, stop_at_coordinates=False):
+    """
+    带磁盘缓存的 analyze_image_with_gpt4o：相同截图和提示词的响应直接从 GPT_CACHE_DIR 读取。
+    出错时返回的提示文本不会写入缓存。
+    """
+    if not base64_image:
+        return analyze_image_with_gpt4o(base64_image, prompt_text, stop_at_coordinates)
+    key_source = f"{int(stop_at_coordinates)}\0{prompt_text}\0{base64_image}"
+    key = hashlib.blake2b(key_source.encode(), digest_size=16).hexdigest()
+    cache_path = GPT_CACHE_DIR / key
+    if cache_path.exists():
+        return cache_path.read_text(encoding="utf-8")
+    response_text = analyze_image_with_gpt4o(base64_image, prompt_text, stop_at_coordinates)
+    if response_text is not None and not response_text.startswith("调用 OpenAI API 时出错"):
+        GPT_CACHE_DIR.mkdir(exist_ok=True)
+        cache_path.write_text(response_text, encoding="utf-8")
+    return response_text
+
 def extract_coordinates(text):
     """
     从文本中提取 (x, y) 格式的坐标。
@@ -124,8 +277,7 @@ def extract_coordinates(text):
     Returns:
         tuple: (x, y) 坐标，如果找到的话；否则返回 None。
     """
-    # 正则表达式查找括号中的两个数字，用逗号分隔，允许空格
-    match = re.search(r"\(\s*(\d+)\s*,\s*(\d+)\s*\)", text)
+    match = _COORD_RE.search(text)
     if match:
         x = int(match.group(1))
         y = int(match.group(2))
@@ -136,63 +288,60 @@ if __name__ == "__main__":
     google_images_url = "https://images.google.com/"
     print(f"正在尝试自动打开浏览器并导航到: {google_images_url}")
     webbrowser.open_new_tab(google_images_url)
-    print("已发送打开网页的指令。请等待页面加载（约10-12秒）。") 
+    print("已发送打开网页的指令。请等待页面加载（最多约17秒，相机图标出现即继续）。") 
     print("重要提示：请在页面加载后，手动确保浏览器窗口是活动且最大化的...")
-    time.sleep(12) # 增加浏览器初始加载等待
 
     print("\n--- 步骤 1: 定位并点击相机图标 --- ")
-    if not os.path.exists(CAMERA_ICON_TEMPLATE_PATH):
+    if CAMERA_ICON_TEMPLATE_PATH not in _TEMPLATES:
         print(f"错误：相机图标模板 '{CAMERA_ICON_TEMPLATE_PATH}' 未找到！")
         exit()
     camera_clicked_successfully = False
     try:
         print(f"查找相机图标模板: '{CAMERA_ICON_TEMPLATE_PATH}'...")
         confidence_level_camera = 0.8 
-        camera_coords = pyautogui.locateCenterOnScreen(CAMERA_ICON_TEMPLATE_PATH, confidence=confidence_level_camera)
+        # 轮询等待浏览器加载出相机图标，取代固定的初始加载等待
+        camera_coords = wait_for(CAMERA_ICON_TEMPLATE_PATH, timeout=17, confidence=confidence_level_camera)
         if camera_coords:
             print(f"找到相机图标: {camera_coords}")
-            time.sleep(1.5) # 增加第一次鼠标移动前的等待
+            time.sleep(0.3) # 让元素稳定后再移动鼠标
             pyautogui.moveTo(camera_coords[0], camera_coords[1], duration=0.25) 
             pyautogui.click(camera_coords[0], camera_coords[1])
             print("已点击相机图标。")
             camera_clicked_successfully = True
             print("等待'上传文件'对话框加载...")
-            time.sleep(1.5) 
         else:
             print(f"未能通过模板找到相机图标 (confidence={confidence_level_camera})。")
-    except pyautogui.ImageNotFoundException:
-        print(f"错误：屏幕上找不到相机图标模板 '{CAMERA_ICON_TEMPLATE_PATH}'。")
     except Exception as e:
         print(f"相机图标处理错误: {e}")
 
     upload_button_clicked_successfully = False
     if camera_clicked_successfully:
         print("\n--- 步骤 2: 定位并点击上传按钮 --- ")
-        if not os.path.exists(UPLOAD_BUTTON_TEMPLATE_PATH):
+        if UPLOAD_BUTTON_TEMPLATE_PATH not in _TEMPLATES:
             print(f"错误：上传按钮模板 '{UPLOAD_BUTTON_TEMPLATE_PATH}' 未找到！")
             print(f"请先创建 '{UPLOAD_BUTTON_TEMPLATE_PATH}' 文件后再试。")
         else:
             try:
                 print(f"查找上传按钮模板: '{UPLOAD_BUTTON_TEMPLATE_PATH}'...")
-                time.sleep(0.5) # 查找前略微等待，确保对话框元素稳定
                 confidence_level_upload = 0.8 
-                upload_coords = pyautogui.locateCenterOnScreen(UPLOAD_BUTTON_TEMPLATE_PATH, confidence=confidence_level_upload)
+                upload_coords = wait_for(UPLOAD_BUTTON_TEMPLATE_PATH, timeout=7, confidence=confidence_level_upload)
                 
                 if upload_coords:
                     print(f"找到上传按钮: {upload_coords}")
                     pyautogui.moveTo(upload_coords[0], upload_coords[1], duration=0.25) # 加快移动
                     # print("已移动到上传按钮，准备点击 (0.5秒后执行)。") # 简化提示
-                    time.sleep(0.5) # 缩短等待
+                    time.sleep(0.3) # 让元素稳定后再点击
                     pyautogui.click(upload_coords[0], upload_coords[1])
                     print("已点击上传按钮。")
                     upload_button_clicked_successfully = True
                     print("等待文件选择对话框出现并获取焦点...")
-                    time.sleep(2) # 缩短等待文件对话框
+                    if DIALOG_OPEN_BUTTON_TEMPLATE_PATH in _TEMPLATES:
+                        wait_for(DIALOG_OPEN_BUTTON_TEMPLATE_PATH, timeout=7) # '打开'按钮出现即说明对话框已弹出
+                    else:
+                        time.sleep(2) # 没有'打开'按钮模板时只能固定等待文件对话框
                 else:
                     print(f"未能通过模板找到上传按钮 (confidence={confidence_level_upload})。")
                     print("请检查模板图片是否准确，以及上传对话框是否在屏幕上清晰可见。")
-            except pyautogui.ImageNotFoundException:
-                print(f"错误：屏幕上找不到上传按钮模板 '{UPLOAD_BUTTON_TEMPLATE_PATH}'。")
             except Exception as e:
                 print(f"上传按钮处理错误: {e}")
     else:
@@ -212,7 +361,7 @@ if __name__ == "__main__":
                 print(f"错误：要上传的图片 '{image_to_upload_abs_path}' 不存在！")
             else:
                 print(f"准备将路径复制到剪贴板并粘贴 (确保对话框焦点)... ")
-                time.sleep(1) # 确保对话框已获取焦点
+                time.sleep(0.3) # 确保对话框已获取焦点
                 
                 pyperclip.copy(image_to_upload_abs_path) # 复制路径到剪贴板
                 print("路径已复制到剪贴板。")
@@ -220,11 +369,11 @@ if __name__ == "__main__":
 
                 pyautogui.hotkey('ctrl', 'v') # 模拟粘贴
                 print("已模拟粘贴 (Ctrl+V)。")
-                time.sleep(1.0) # 允许路径在对话框中显示和注册
+                time.sleep(0.3) # 允许路径在对话框中显示和注册
                 
                 print(f"正在查找并点击'打开'按钮模板: '{DIALOG_OPEN_BUTTON_TEMPLATE_PATH}'...")
                 confidence_level_dialog_open = 0.8 # 可调整的置信度
-                open_button_coords = pyautogui.locateCenterOnScreen(DIALOG_OPEN_BUTTON_TEMPLATE_PATH, confidence=confidence_level_dialog_open)
+                open_button_coords = wait_for(DIALOG_OPEN_BUTTON_TEMPLATE_PATH, timeout=5, confidence=confidence_level_dialog_open)
                 
                 if open_button_coords:
                     print(f"找到'打开'按钮: {open_button_coords}")
@@ -257,8 +406,6 @@ if __name__ == "__main__":
                         time.sleep(0.6) # 略微减少滚动间隙，但保持平滑感
                     print("已完成模拟滚动浏览。")
 
-        except pyautogui.ImageNotFoundException as e:
-             print(f"PyAutoGUI错误：在步骤3中找不到模板: {e}") # More specific error
         except Exception as e:
             print(f"在处理文件上传步骤中发生错误: {e}")
             
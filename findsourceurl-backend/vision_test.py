@@ -1,7 +1,68 @@
+import asyncio
+import functools
 import io
 import os
 from google.cloud import vision
 
+# batch_annotate_images 单次请求最多接受 16 张图片
+MAX_IMAGES_PER_BATCH = 16
+
+@functools.lru_cache(maxsize=32)
+def _cached_image(expanded_path, mtime_ns, size):
+    with io.open(expanded_path, 'rb') as image_file:
+        return vision.Image(content=image_file.read())
+
+def _load_image(expanded_path):
+    """Builds the vision.Image for a local path or gs:// URI, reusing it while the file is unchanged."""
+    # 已在 GCS 上的图片直接让服务端读取，不必在客户端读入再上传
+    if expanded_path.startswith('gs://'):
+        return vision.Image(source=vision.ImageSource(image_uri=expanded_path))
+    stat = os.stat(expanded_path)
+    return _cached_image(expanded_path, stat.st_mtime_ns, stat.st_size)
+
+def _print_web_detection(annotations):
+    """Prints the web detection annotations for one image."""
+    print("\n--- Web Entities ---")
+    if annotations.web_entities:
+        for entity in annotations.web_entities:
+            print(f"  描述: {entity.description}, Score: {entity.score:.4f}")
+    else:
+        print("  未找到Web Entities。")
+
+    print("\n--- Pages with Matching Images ---")
+    if annotations.pages_with_matching_images:
+        for page in annotations.pages_with_matching_images:
+            print(f"  页面URL: {page.url}")
+            if page.page_title:
+                print(f"    页面标题: {page.page_title.strip()}")
+            if page.full_matching_images:
+                print(f"    包含 {len(page.full_matching_images)} 个完全匹配的图片。")
+            if page.partial_matching_images:
+                print(f"    包含 {len(page.partial_matching_images)} 个部分匹配的图片。")
+    else:
+        print("  未找到包含匹配图片的页面。")
+
+    print("\n--- Full Matching Images (来自网络的独立图片链接) ---")
+    if annotations.full_matching_images:
+        for image_match in annotations.full_matching_images:
+            print(f"  图片URL: {image_match.url}")
+    else:
+        print("  未找到完全匹配的图片。")
+
+    print("\n--- Partial Matching Images (来自网络的独立图片链接) ---")
+    if annotations.partial_matching_images:
+        for image_match in annotations.partial_matching_images:
+            print(f"  图片URL: {image_match.url}")
+    else:
+        print("  未找到部分匹配的图片。")
+
+    print("\n--- Visually Similar Images (来自网络的独立图片链接) ---")
+    if annotations.visually_similar_images:
+        for image_match in annotations.visually_similar_images:
+            print(f"  图片URL: {image_match.url}")
+    else:
+        print("  未找到视觉上相似的图片。")
+
 def detect_web_references(image_path):
     """Detects web references to an image."""
     client = vision.ImageAnnotatorClient()
@@ -10,9 +71,7 @@ def detect_web_references(image_path):
     expanded_path = os.path.expanduser(image_path)
 
     try:
-        with io.open(expanded_path, 'rb') as image_file:
-            content = image_file.read()
-        image = vision.Image(content=content)
+        image = _load_image(expanded_path)
 
         print(f"正在分析图片: {expanded_path}")
         response = client.web_detection(image=image)
@@ -22,50 +81,41 @@ def detect_web_references(image_path):
             print(f"API返回错误: {response.error.message}")
             return
 
-        print("\n--- Web Entities ---")
-        if annotations.web_entities:
-            for entity in annotations.web_entities:
-                print(f"  描述: {entity.description}, Score: {entity.score:.4f}")
-        else:
-            print("  未找到Web Entities。")
-
-        print("\n--- Pages with Matching Images ---")
-        if annotations.pages_with_matching_images:
-            for page in annotations.pages_with_matching_images:
-                print(f"  页面URL: {page.url}")
-                if page.page_title:
-                    print(f"    页面标题: {page.page_title.strip()}")
-                if page.full_matching_images:
-                    print(f"    包含 {len(page.full_matching_images)} 个完全匹配的图片。")
-                if page.partial_matching_images:
-                    print(f"    包含 {len(page.partial_matching_images)} 个部分匹配的图片。")
-        else:
-            print("  未找到包含匹配图片的页面。")
-
-        print("\n--- Full Matching Images (来自网络的独立图片链接) ---")
-        if annotations.full_matching_images:
-            for image_match in annotations.full_matching_images:
-                print(f"  图片URL: {image_match.url}")
-        else:
-            print("  未找到完全匹配的图片。")
-
-        print("\n--- Partial Matching Images (来自网络的独立图片链接) ---")
-        if annotations.partial_matching_images:
-            for image_match in annotations.partial_matching_images:
-                print(f"  图片URL: {image_match.url}")
-        else:
-            print("  未找到部分匹配的图片。")
-
-        print("\n--- Visually Similar Images (来自网络的独立图片链接) ---")
-        if annotations.visually_similar_images:
-            for image_match in annotations.visually_similar_images:
-                print(f"  图片URL: {image_match.url}")
-        else:
-            print("  未找到视觉上相似的图片。")
+        _print_web_detection(annotations)
 
     except Exception as e:
         print(f"执行脚本时发生错误 (路径: {expanded_path}): {e}")
 
+async def detect_web_references_batch(image_paths):
+    """Detects web references to several images, one batch request per 16 images."""
+    client = vision.ImageAnnotatorAsyncClient()
+    expanded_paths = [os.path.expanduser(path) for path in image_paths]
+    feature = vision.Feature(type_=vision.Feature.Type.WEB_DETECTION)
+
+    try:
+        requests = [
+            vision.AnnotateImageRequest(image=_load_image(expanded_path), features=[feature])
+            for expanded_path in expanded_paths
+        ]
+
+        # 每批图片只需一次网络往返，多个批次并发提交
+        batches = [requests[i:i + MAX_IMAGES_PER_BATCH] for i in range(0, len(requests), MAX_IMAGES_PER_BATCH)]
+        print(f"正在批量分析 {len(requests)} 张图片 ({len(batches)} 个请求)...")
+        batch_responses = await asyncio.gather(
+            *(client.batch_annotate_images(requests=batch) for batch in batches)
+        )
+        responses = [response for batch_response in batch_responses for response in batch_response.responses]
+
+        for expanded_path, response in zip(expanded_paths, responses):
+            print(f"\n===== 图片: {expanded_path} =====")
+            if response.error.message:
+                print(f"API返回错误: {response.error.message}")
+                continue
+            _print_web_detection(response.web_detection)
+
+    except Exception as e:
+        print(f"批量分析时发生错误: {e}")
+
 if __name__ == '__main__':
     # 请将这里的路径替换为您测试图片的实际路径
     # Windows路径示例: r"C:\Users\YourUser\Pictures\test_image.png"